@@ -11,6 +11,26 @@ class ConfigLoader:
         self.baudrate = int(config['BAUDRATE'])
         self.temperature = int(config['TEMPERATURE'])
         self.folder = config['FOLDER']
+        self.settle_time = float(config.get('SETTLE_TIME', 0.05))  # 停止確認後の待ち時間 [s]
+        self.serial_timeout = float(config.get('SERIAL_TIMEOUT', 1))  # ステージの返答の待ち時間の上限 [s]
+        self.move_timeout = float(config.get('MOVE_TIMEOUT', 60))  # 移動の待ち時間の上限 [s]
+        self.acquisition_mode = config.get('ACQUISITION_MODE', 'SINGLE')  # SINGLE, ACCUMULATE or KINETICS
+        if self.acquisition_mode not in ['SINGLE', 'ACCUMULATE', 'KINETICS']:
+            raise ValueError('Error with config.json. ACQUISITION_MODE must be SINGLE, ACCUMULATE or KINETICS.')
+        self.cycle_time = float(config.get('CYCLE_TIME', 0))  # 積算・連続撮影の周期 [s]．0なら最短
+        self.spike_rejection = bool(config.get('SPIKE_REJECTION', True))  # フレーム間で宇宙線を除くか
+        self.rejection_threshold = float(config.get('REJECTION_THRESHOLD', 5))  # 何σ外れたら宇宙線とみなすか
+        self.display_points = int(config.get('DISPLAY_POINTS', 0))  # 表示用に間引く点数．0なら間引かない
+        self.adaptive_tolerance = float(config.get('ADAPTIVE_TOLERANCE', 0.05))  # これ以下の変化の区間には点を足さない
+        self.adaptive_spacing = float(config.get('ADAPTIVE_SPACING', 0.1))  # 点の間隔の下限 [μm]
+        self.snr_max_frames = int(config.get('SNR_MAX_FRAMES', 200))  # SN比モードで1点に積算する枚数の上限
+        self.save_asc = bool(config.get('SAVE_ASC', False))  # スキャン後に.ascへも書き出すか
+        self.spike_removal_passes = int(config.get('SPIKE_REMOVAL_PASSES', 3))  # 測定中の宇宙線除去を何回かけるか
+        self.calibration_cache = config.get('CALIBRATION_CACHE', None)  # 校正結果を残すファイル．Noneならホームフォルダ
+        # SIMULATIONモードの仮想ステージ・仮想カメラの設定
+        self.sim_latency = float(config.get('SIM_LATENCY', 0.002))  # ステージの応答時間 [s]
+        self.sim_readout_time = float(config.get('SIM_READOUT_TIME', 0.01))  # 1フレームの読み出し時間 [s]
+        self.sim_cosmic_rate = float(config.get('SIM_COSMIC_RATE', 0.05))  # 1秒の露光あたりの宇宙線の数
 
 
 def main():
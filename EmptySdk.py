@@ -1,12 +1,31 @@
 import os
+from types import SimpleNamespace
 if os.name == 'nt':
     from pyAndorSDK2 import atmcd_codes, atmcd_errors
-import numpy as npf
+else:
+    # pyAndorSDK2はWindowsにしかないので，使う定数だけ同じ値で用意する
+    atmcd_codes = SimpleNamespace(
+        Acquisition_Mode=SimpleNamespace(SINGLE_SCAN=1, ACCUMULATE=2, KINETICS=3, FAST_KINETICS=4, RUN_TILL_ABORT=5),
+        Read_Mode=SimpleNamespace(FULL_VERTICAL_BINNING=0),
+        Trigger_Mode=SimpleNamespace(INTERNAL=0),
+    )
+    atmcd_errors = SimpleNamespace(
+        Error_Codes=SimpleNamespace(DRV_SUCCESS=20002, DRV_ACQUIRING=20072, DRV_IDLE=20073, DRV_TEMP_STABILIZED=20036,
+                                    DRV_TEMP_NOT_REACHED=20037, DRV_NO_NEW_DATA=20024),
+    )
+import numpy as np
 
 
 class EmptySdk:
     def __init__(self):
         self.theta = 0
+        self.xpixels = 100
+        self.acquisition_mode = atmcd_codes.Acquisition_Mode.SINGLE_SCAN
+        self.number_accumulations = 1
+        self.number_kinetics = 1
+        self.exposure_time = 0
+        self.kinetic_cycle_time = 0
+        self.data = np.zeros(self.xpixels)
 
     def handle_return(self, *args):
         print('handle_return:', args)
@@ -26,7 +45,23 @@ class EmptySdk:
         return atmcd_errors.Error_Codes.DRV_TEMP_STABILIZED, 0
 
     def SetAcquisitionMode(self, arg):
-        print('SetAcquisitionMode')
+        print('SetAcquisitionMode', arg)
+        self.acquisition_mode = arg
+
+    def SetNumberAccumulations(self, number):
+        print('SetNumberAccumulations', number)
+        self.number_accumulations = number
+
+    def SetAccumulationCycleTime(self, time):
+        print('SetAccumulationCycleTime', time)
+
+    def SetNumberKinetics(self, number):
+        print('SetNumberKinetics', number)
+        self.number_kinetics = number
+
+    def SetKineticCycleTime(self, time):
+        print('SetKineticCycleTime', time)
+        self.kinetic_cycle_time = time
 
     def SetReadMode(self, arg):
         print('SetReadMode')
@@ -36,25 +71,46 @@ class EmptySdk:
 
     def GetDetector(self):
         print('GetDetector')
-        return None, None, None
+        return None, self.xpixels, 1
 
     def SetExposureTime(self, exposure_time):
         print('SetExposureTime', exposure_time)
+        self.exposure_time = exposure_time
+
+    def GetAcquisitionTimings(self):
+        kinetic = max(self.exposure_time, self.kinetic_cycle_time)
+        return atmcd_errors.Error_Codes.DRV_SUCCESS, self.exposure_time, self.exposure_time, kinetic
 
     def PrepareAcquisition(self):
         print('PrepareAcquisition')
 
+    def spectrum(self):
+        self.theta += 0.1
+        val_range = np.linspace(0, 4, self.xpixels)
+        return np.sin(val_range + self.theta)
+
     def StartAcquisition(self):
         print('StartAcquisition')
+        if self.acquisition_mode == atmcd_codes.Acquisition_Mode.ACCUMULATE:  # カメラ内で積算した1枚
+            self.data = np.sum([self.spectrum() for _ in range(self.number_accumulations)], axis=0)
+        elif self.acquisition_mode == atmcd_codes.Acquisition_Mode.KINETICS:  # 連続して撮った複数枚
+            self.data = np.concatenate([self.spectrum() for _ in range(self.number_kinetics)])
+        else:
+            self.data = self.spectrum()
 
     def WaitForAcquisition(self):
         print('WaitForAcquisition')
 
+    def GetStatus(self):
+        return atmcd_errors.Error_Codes.DRV_SUCCESS, atmcd_errors.Error_Codes.DRV_IDLE
+
+    def GetAcquiredData(self, size):
+        print('GetAcquiredData', size)
+        return None, self.data[:size]
+
     def GetImages16(self, *args):
-        self.theta += 0.1
-        val_range = np.linspace(0, 4, 100)
         print('GetImages16')
-        return None, np.sin(val_range + self.theta), None, None
+        return None, self.spectrum(), None, None
 
     def SaveAsSif(self, path):
         print('SaveAsSif', path)
@@ -1,8 +1,39 @@
+import collections
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future, CancelledError, TimeoutError as FutureTimeoutError
+
+PRIORITY_EMERGENCY = 0  # 非常停止は常に最優先
+PRIORITY_COMMAND = 1
+PRIORITY_QUERY = 2
+
+
 class HSC103Controller:
-    def __init__(self, ser=None):
+    """
+    シリアルポートは専用のスレッドだけが読み書きする．
+    各コマンドは優先度付きキューに入れられ，1つずつ送信して返答を受け取ってから次に進むので，
+    返答が別のコマンドのものと入れ替わることはない．呼び出し側には返答を入れたFutureを返す．
+    キューが空いている間はポーリングで位置を取得し，get_positionはその最新値を返す．
+    serにはtimeoutを設定して渡す．時間内に返答が来なければそのコマンドのFutureをTimeoutErrorで失敗させ，次に進む．
+    """
+    def __init__(self, ser=None, poll_interval: float = 0.2, history: int = 10000):
         self.ser = ser
         self.end = '\r\n'
 
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()  # 同じ優先度のコマンドは送った順に処理する
+        self.poll_interval = poll_interval
+        self.position = [0, 0, 0]
+        self.position_time = 0
+        self.position_history = collections.deque(maxlen=history)  # (時刻, [x, y, z])
+        self.speeds = [None, None, None]  # set_speedで設定した各軸の(start, final, rate)
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
         self.check_status()
 
     def send(self, order: str):
@@ -14,36 +45,146 @@ class HSC103Controller:
     def recv(self) -> str:
         if self.ser is None:
             return 'some response'
-        msg = self.ser.readline().decode()
-        msg.strip(self.end)
-        return msg
+        msg = self.ser.readline()
+        if not msg.endswith(b'\n'):
+            # 返答が途切れた．遅れて届いた分が次の返答と混ざらないよう捨てる
+            self.ser.reset_input_buffer()
+            raise TimeoutError(f'no response from HSC-103 (received {msg!r})')
+        return msg.decode().strip(self.end)
+
+    def run(self):
+        # シリアルポートを読み書きするのはこのスレッドだけ
+        while True:
+            try:
+                priority, _, order, future = self.queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                if self.ser is not None:
+                    try:
+                        self.poll_position()
+                    except Exception as e:  # ポーリングの失敗でこのスレッドを止めない
+                        print('failed in polling position:', e)
+                continue
+            if order is None:  # 終了の合図
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                self.send(order)
+                msg = self.recv()
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            future.set_result(msg)
+
+    def submit(self, order: str, priority: int = PRIORITY_COMMAND) -> Future:
+        future = Future()
+        self.queue.put((priority, next(self.counter), order, future))
+        return future
+
+    def request(self, order: str, priority: int = PRIORITY_COMMAND, timeout: float = None) -> str:
+        # 返答が来るまで待つ
+        return self.submit(order, priority).result(timeout=timeout)
+
+    def close(self):
+        self.queue.put((PRIORITY_EMERGENCY, -1, None, None))
+        self.thread.join()
 
     def check_status(self):
         msg = '!:'
-        self.send(msg)
-        print(msg, self.recv())
+        print(msg, self.request(msg, PRIORITY_QUERY))
         for command in ['N', 'V', 'P']:
             msg = f'?:{command}'
-            self.send(msg)
-            print(msg, self.recv())
+            print(msg, self.request(msg, PRIORITY_QUERY))
         for i, axis in enumerate(['x', 'y', 'z']):
             print()
             print(axis)
             for command in ['D', 'B']:
                 msg = f'?:{command}{i + 1}'
-                self.send(msg)
-                print(msg, self.recv())
+                print(msg, self.request(msg, PRIORITY_QUERY))
 
-    def get_position(self):
-        order = 'Q:'
-        self.send(order)
-        msg = self.recv()
+    def poll_position(self):
+        self.send('Q:')
+        self.update_position(self.recv())
+
+    def update_position(self, msg: str):
         try:
             pos_list = list(map(int, msg.split(',')))
         except ValueError:
-            pos_list = [0, 0, 0]
+            print('invalid position:', msg)
+            return None
+        with self.lock:
+            self.position = pos_list
+            self.position_time = time.time()
+            self.position_history.append((self.position_time, pos_list))
         return pos_list
 
+    def query_position(self) -> Future:
+        # 位置を問い合わせ，返答をキャッシュにも反映する
+        future = Future()
+
+        def done(f):
+            if f.cancelled():
+                future.cancel()
+            elif f.exception() is not None:
+                future.set_exception(f.exception())
+            else:
+                future.set_result(self.update_position(f.result()))
+        self.submit('Q:', PRIORITY_QUERY).add_done_callback(done)
+        return future
+
+    def get_position(self):
+        # 最後に取得した位置を返す．シリアル通信は行わない．
+        with self.lock:
+            return list(self.position)
+
+    def get_position_history(self):
+        with self.lock:
+            return list(self.position_history)
+
+    def is_ready(self) -> bool:
+        """
+        ステータス(!:)を問い合わせ，全軸が停止していればTrue．
+        問い合わせが非常停止で取り消されたか返答がなかった場合は，止まったか分からないのでFalse．
+        """
+        try:
+            return self.query_ready()
+        except (CancelledError, FutureTimeoutError, TimeoutError):
+            return False
+
+    def query_ready(self) -> bool:
+        # is_readyと同じだが，取り消しと返答なしは例外のまま返す
+        if self.ser is None:
+            return True
+        return self.request('!:', PRIORITY_QUERY).strip() == 'R'  # R: Ready, B: Busy
+
+    def wait_until_ready(self, settle: float = 0.05, timeout: float = 60, interval: float = 0.01) -> bool:
+        """
+        移動が終わるまで待つ．
+        Args:
+            settle (float): 停止を確認してから待つ時間 [s]．振動が収まるのを待つ．
+            timeout (float): これを超えても停止しなければ諦める [s]．
+            interval (float): ステータスを問い合わせる間隔 [s]．
+
+        Returns:
+            bool (bool): 時間内に停止すればTrue．非常停止で問い合わせが取り消された場合もFalse．
+        """
+        t_end = time.time() + timeout
+        while True:
+            try:
+                if self.query_ready():
+                    break
+            except CancelledError:
+                print('stopped: status query was cancelled')
+                return False
+            except (FutureTimeoutError, TimeoutError) as e:
+                print('no status:', e)  # 返答がなければ止まっていないとみなして問い合わせ直す
+            if time.time() > t_end:
+                print('timeout: stage did not stop')
+                return False
+            time.sleep(interval)
+        time.sleep(settle)
+        return True
+
     def move_abs(self, values: list):
         """
 
@@ -51,7 +192,7 @@ class HSC103Controller:
             values (list(int)): 各軸の移動量[pulse]を指定．1 pulse あたり 0.01 μm 進む．
 
         Returns:
-            bool (bool): 返答がOKならTrue．
+            future (Future): 返答を受け取るFuture．返答がOKなら'OK'が入る．
 
         """
 
@@ -60,7 +201,7 @@ class HSC103Controller:
             return False
 
         order = 'A:' + ','.join([str(int(val)) for val in values])
-        self.send(order)
+        return self.submit(order)
 
     def move_linear(self, coord: list):
         """
@@ -69,7 +210,7 @@ class HSC103Controller:
             coord (list(int)): 現在位置から見た終点の位置 [pulse]．1 pulse あたり 0.01 μm 進む．
 
         Returns:
-            bool (bool): 返答がOKならTrue．
+            future (Future): 返答を受け取るFuture．返答がOKなら'OK'が入る．
 
         """
 
@@ -78,7 +219,7 @@ class HSC103Controller:
             return False
 
         order = 'K:' + ','.join([str(int(val)) for val in [1, 2, 3] + coord])
-        self.send(order)
+        return self.submit(order)
 
     def jog(self, args: list):
         """
@@ -87,6 +228,7 @@ class HSC103Controller:
             args list(int): 各軸の進行方向を1か-1で指定．動かない場合は0．
 
         Returns:
+            future (Future): 返答を受け取るFuture．
 
         """
 
@@ -106,11 +248,24 @@ class HSC103Controller:
             elif s == 1:
                 order += '+,'
         order = order[:-1]
-        self.send(order)
+        return self.submit(order)
 
     def stop_emergency(self):
+        # 送信待ちのコマンドは取り消し，キューの先頭から送る
+        self.cancel_pending()
         order = 'L:E'
-        self.send(order)
+        return self.submit(order, PRIORITY_EMERGENCY)
+
+    def cancel_pending(self):
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item[2] is None:  # 終了の合図は残す
+                self.queue.put(item)
+                break
+            item[3].cancel()
 
     def set_speed(self, args: list):
         """
@@ -121,7 +276,7 @@ class HSC103Controller:
             rateは最大速度に到達するまでの時間で範囲は 1~1000 [ms]．
 
         Returns:
-            bool (bool): 返答がOKならTrue．
+            future (Future): 返答を受け取るFuture．返答がOKなら'OK'が入る．
         """
 
         if len(args) != 4:
@@ -138,11 +293,11 @@ class HSC103Controller:
             return False
 
         order = 'D:' + ','.join([str(int(val)) for val in args])
-        self.send(order)
+        self.speeds[axis - 1] = (start, final, rate)
+        return self.submit(order)
 
     def set_speed_all(self, args: list):
-        for i in range(1, 4):
-            self.set_speed([i] + args)
+        return [self.set_speed([i] + args) for i in range(1, 4)]
 
     def set_speed_max(self):
         return self.set_speed_all([2000000, 4000000, 1])
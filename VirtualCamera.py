@@ -0,0 +1,207 @@
+import time
+import numpy as np
+from EmptySdk import atmcd_codes, atmcd_errors
+
+UM_PER_PULSE = 0.01
+# 疑似スペクトルのピーク (画素, 幅 [pixel], 強度 [count/s])
+PEAKS = [(180, 4, 4000), (512, 3, 12000), (760, 6, 2500)]
+
+
+def default_pattern(position):
+    """
+    試料の模様．原点を中心とした半径5μmの円の中だけピークが強い．
+    Args:
+        position (list): ステージの位置 [pulse]．
+
+    Returns:
+        factor (float): ピーク強度にかける倍率．
+    """
+    r = np.hypot(position[0], position[1]) * UM_PER_PULSE
+    return 0.2 + 0.8 / (1 + np.exp((r - 5) / 0.5))
+
+
+class VirtualCamera:
+    """
+    Andorのカメラのふりをする．atmcdのうちmain.pyで使う関数だけを持つ．
+    露光時間と読み出し時間だけ実際に待たせ，ショットノイズ・読み出しノイズ・宇宙線を乗せた1024画素のスペクトルを返す．
+    stageにVirtualHSC103を渡すと，露光の中心時刻のステージの位置でpatternの倍率をピークにかける．
+    """
+    def __init__(self, stage=None, xpixels: int = 1024, readout_time: float = 0.01, read_noise: float = 6,
+                 cosmic_rate: float = 0.05, cooling_rate: float = 20, pattern=default_pattern, seed=None):
+        self.stage = stage
+        self.xpixels = xpixels
+        self.readout_time = readout_time  # 1フレームの読み出し時間 [s]
+        self.read_noise = read_noise  # [count]
+        self.cosmic_rate = cosmic_rate  # 1秒の露光あたりの宇宙線の数
+        self.cooling_rate = cooling_rate  # [℃/s]
+        self.pattern = pattern
+        self.rng = np.random.default_rng(seed)
+
+        self.bias = 300
+        pixels = np.arange(xpixels)
+        self.background = 30 * (1 + pixels / xpixels)  # 蛍光のなだらかな背景 [count/s]
+        self.peaks = np.zeros(xpixels)
+        for center, width, intensity in PEAKS:
+            self.peaks += intensity / (1 + ((pixels - center * xpixels / 1024) / width) ** 2)
+
+        self.acquisition_mode = atmcd_codes.Acquisition_Mode.SINGLE_SCAN
+        self.exposure_time = 0.1
+        self.number_accumulations = 1
+        self.number_kinetics = 1
+        self.accumulation_cycle_time = 0
+        self.kinetic_cycle_time = 0
+        self.t_start = None
+        self.num_waited = 0
+
+        self.target_temperature = 20
+        self.t_cooler = None
+
+    def handle_return(self, ret):
+        if ret != atmcd_errors.Error_Codes.DRV_SUCCESS:
+            raise RuntimeError(f'Error from virtual camera: {ret}')
+        return ret
+
+    def Initialize(self, arg):
+        return atmcd_errors.Error_Codes.DRV_SUCCESS
+
+    def ShutDown(self):
+        return atmcd_errors.Error_Codes.DRV_SUCCESS
+
+    def SetTemperature(self, temperature):
+        self.target_temperature = temperature
+        return atmcd_errors.Error_Codes.DRV_SUCCESS
+
+    def CoolerON(self):
+        self.t_cooler = time.time()
+        return atmcd_errors.Error_Codes.DRV_SUCCESS
+
+    def GetTemperature(self):
+        if self.t_cooler is None:
+            return atmcd_errors.Error_Codes.DRV_TEMP_NOT_REACHED, 20
+        temperature = max(self.target_temperature, 20 - self.cooling_rate * (time.time() - self.t_cooler))
+        if temperature <= self.target_temperature:
+            return atmcd_errors.Error_Codes.DRV_TEMP_STABILIZED, int(temperature)
+        return atmcd_errors.Error_Codes.DRV_TEMP_NOT_REACHED, int(temperature)
+
+    def SetAcquisitionMode(self, mode):
+        self.acquisition_mode = mode
+        return atmcd_errors.Error_Codes.DRV_SUCCESS
+
+    def SetReadMode(self, mode):
+        return atmcd_errors.Error_Codes.DRV_SUCCESS
+
+    def SetTriggerMode(self, mode):
+        return atmcd_errors.Error_Codes.DRV_SUCCESS
+
+    def GetDetector(self):
+        return atmcd_errors.Error_Codes.DRV_SUCCESS, self.xpixels, 256
+
+    def SetExposureTime(self, exposure_time):
+        self.exposure_time = float(exposure_time)
+        return atmcd_errors.Error_Codes.DRV_SUCCESS
+
+    def SetNumberAccumulations(self, number):
+        self.number_accumulations = int(number)
+        return atmcd_errors.Error_Codes.DRV_SUCCESS
+
+    def SetAccumulationCycleTime(self, cycle_time):
+        self.accumulation_cycle_time = float(cycle_time)
+        return atmcd_errors.Error_Codes.DRV_SUCCESS
+
+    def SetNumberKinetics(self, number):
+        self.number_kinetics = int(number)
+        return atmcd_errors.Error_Codes.DRV_SUCCESS
+
+    def SetKineticCycleTime(self, cycle_time):
+        self.kinetic_cycle_time = float(cycle_time)
+        return atmcd_errors.Error_Codes.DRV_SUCCESS
+
+    def GetAcquisitionTimings(self):
+        # 実際の露光時間，積算の周期，連続撮影の周期．読み出しより短い周期にはならない
+        accumulate = max(self.exposure_time + self.readout_time, self.accumulation_cycle_time)
+        kinetic = max(accumulate, self.kinetic_cycle_time)
+        return atmcd_errors.Error_Codes.DRV_SUCCESS, self.exposure_time, accumulate, kinetic
+
+    def PrepareAcquisition(self):
+        return atmcd_errors.Error_Codes.DRV_SUCCESS
+
+    def get_cycle(self):
+        ret, exposure, accumulate, kinetic = self.GetAcquisitionTimings()
+        if self.acquisition_mode == atmcd_codes.Acquisition_Mode.ACCUMULATE:
+            return accumulate, self.number_accumulations
+        if self.acquisition_mode == atmcd_codes.Acquisition_Mode.KINETICS:
+            return kinetic, self.number_kinetics
+        return accumulate, 1
+
+    def StartAcquisition(self):
+        self.t_start = time.time()
+        self.num_waited = 0
+        return atmcd_errors.Error_Codes.DRV_SUCCESS
+
+    def frame_end(self, index: int):
+        # index番目(0始まり)のフレームの読み出しが終わる時刻
+        cycle, number = self.get_cycle()
+        return self.t_start + index * cycle + self.exposure_time + self.readout_time
+
+    def WaitForAcquisition(self):
+        # 次のフレームが読み出されるまで待つ
+        cycle, number = self.get_cycle()
+        if self.t_start is None or self.num_waited >= number:
+            return atmcd_errors.Error_Codes.DRV_SUCCESS
+        delay = self.frame_end(self.num_waited) - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.num_waited += 1
+        return atmcd_errors.Error_Codes.DRV_SUCCESS
+
+    def GetStatus(self):
+        cycle, number = self.get_cycle()
+        if self.t_start is not None and time.time() < self.frame_end(number - 1):
+            return atmcd_errors.Error_Codes.DRV_SUCCESS, atmcd_errors.Error_Codes.DRV_ACQUIRING
+        return atmcd_errors.Error_Codes.DRV_SUCCESS, atmcd_errors.Error_Codes.DRV_IDLE
+
+    def frame(self, index: int):
+        """
+        index番目(0始まり)のフレームを作る．
+        Returns:
+            frame (np.ndarray): ノイズと宇宙線を乗せたカウント．
+        """
+        cycle, number = self.get_cycle()
+        factor = 1
+        if self.stage is not None:
+            t_mid = self.t_start + index * cycle + self.exposure_time / 2
+            factor = self.pattern(self.stage.get_position(t_mid))
+        expected = (self.background + self.peaks * factor) * self.exposure_time
+        frame = self.rng.poisson(expected) + self.bias + self.rng.normal(0, self.read_noise, self.xpixels)
+        for _ in range(self.rng.poisson(self.cosmic_rate * self.exposure_time)):
+            # 宇宙線は1〜2画素に乗る
+            pixel = self.rng.integers(self.xpixels)
+            frame[pixel:pixel + self.rng.integers(1, 3)] += self.rng.uniform(500, 20000)
+        return frame
+
+    def is_available(self, index: int):
+        return self.t_start is not None and time.time() >= self.frame_end(index)
+
+    def GetAcquiredData(self, size):
+        cycle, number = self.get_cycle()
+        if not self.is_available(number - 1):
+            return atmcd_errors.Error_Codes.DRV_ACQUIRING, np.zeros(0, dtype=np.int32)
+        frames = np.array([self.frame(i) for i in range(number)])
+        if self.acquisition_mode == atmcd_codes.Acquisition_Mode.ACCUMULATE:  # カメラ内で積算した1枚
+            data = frames.sum(axis=0)
+        else:
+            data = frames.ravel()
+        data = np.clip(np.round(data), 0, np.iinfo(np.int32).max).astype(np.int32)
+        return atmcd_errors.Error_Codes.DRV_SUCCESS, data[:size]
+
+    def GetImages16(self, first, last, size):
+        # first番目からlast番目(1始まり)のフレーム
+        if not self.is_available(last - 1):
+            return atmcd_errors.Error_Codes.DRV_NO_NEW_DATA, np.zeros(0, dtype=np.uint16), first, last
+        frames = np.concatenate([self.frame(i) for i in range(first - 1, last)])
+        data = np.clip(np.round(frames), 0, 65535).astype(np.uint16)
+        return atmcd_errors.Error_Codes.DRV_SUCCESS, data[:size], first, last
+
+    def SaveAsSif(self, path):
+        # .sifは書けないので何もしない
+        return atmcd_errors.Error_Codes.DRV_SUCCESS
@@ -0,0 +1,202 @@
+import os
+import threading
+import time
+import numpy as np
+try:
+    import tty  # 疑似端末を使うのでUnixのみ．Windowsにはtermiosがない
+except ImportError:
+    raise ImportError('SIMULATION mode is not supported on this platform: the virtual HSC-103 needs a pseudo terminal (Linux or macOS).')
+
+PULSE_LIMIT = 10000000  # ジョグで進める範囲 [pulse]
+
+
+class AxisMotion:
+    """
+    1軸の台形速度パターンの移動．
+    """
+    def __init__(self, position: float = 0):
+        self.p0 = position
+        self.p1 = position
+        self.t0 = 0
+        self.v0 = 1
+        self.v1 = 1
+        self.acceleration = np.inf
+        self.duration = 0
+        self.t_acc = 0
+        self.d_acc = 0
+
+    def start(self, position: float, target: float, t: float, speed: tuple):
+        start, final, rate = speed
+        self.p0 = position
+        self.p1 = target
+        self.t0 = t
+        self.v0 = start
+        distance = abs(target - position)
+        if final <= start:
+            self.acceleration = np.inf
+            self.v1 = final
+            self.t_acc = 0
+            self.d_acc = 0
+        else:
+            self.acceleration = (final - start) / (rate * 0.001)
+            # 最大速度に届かない場合は途中で減速に移る
+            self.v1 = min(final, np.sqrt(start ** 2 + self.acceleration * distance))
+            self.t_acc = (self.v1 - start) / self.acceleration
+            self.d_acc = (self.v1 ** 2 - start ** 2) / (2 * self.acceleration)
+        self.duration = 2 * self.t_acc + (distance - 2 * self.d_acc) / self.v1
+
+    def position(self, t: float) -> float:
+        dt = t - self.t0
+        if dt >= self.duration:
+            return self.p1
+        if dt <= 0:
+            return self.p0
+        if dt < self.t_acc:  # 加速中
+            d = self.v0 * dt + self.acceleration * dt ** 2 / 2
+        elif dt < self.duration - self.t_acc:  # 等速
+            d = self.d_acc + self.v1 * (dt - self.t_acc)
+        else:  # 減速中
+            dt_left = self.duration - dt
+            d = abs(self.p1 - self.p0) - (self.v0 * dt_left + self.acceleration * dt_left ** 2 / 2)
+        return self.p0 + np.sign(self.p1 - self.p0) * d
+
+    def is_busy(self, t: float) -> bool:
+        return t - self.t0 < self.duration
+
+
+class VirtualHSC103:
+    """
+    疑似端末上でHSC-103のふりをする．
+    HSC103Controllerにはportをserial.Serialで開いて渡す．
+    Q:, !:, A:, K:, J:, D:, L:E, ?:に答え，各軸は設定した速度・加速時間で有限の時間をかけて動く．
+    """
+    def __init__(self, latency: float = 0.002, speed: tuple = (2000000, 4000000, 1)):
+        self.latency = latency  # コマンドを受けてから返答するまでの時間 [s]
+        self.speeds = [tuple(speed) for _ in range(3)]
+        self.axes = [AxisMotion() for _ in range(3)]
+        self.lock = threading.Lock()
+        self.num_commands = 0
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        os.close(self.slave)
+        os.close(self.master)
+
+    def run(self):
+        buffer = b''
+        while self.running:
+            try:
+                buffer += os.read(self.master, 1024)
+            except OSError:
+                break
+            while b'\r\n' in buffer:
+                line, buffer = buffer.split(b'\r\n', 1)
+                reply = self.handle(line.decode())
+                time.sleep(self.latency)
+                try:
+                    os.write(self.master, (reply + '\r\n').encode())
+                except OSError:
+                    return
+
+    def get_position(self, t: float = None):
+        if t is None:
+            t = time.time()
+        with self.lock:
+            return [axis.position(t) for axis in self.axes]
+
+    def is_busy(self, t: float = None):
+        if t is None:
+            t = time.time()
+        with self.lock:
+            return any(axis.is_busy(t) for axis in self.axes)
+
+    def move(self, targets: list):
+        t = time.time()
+        with self.lock:
+            for i, target in enumerate(targets):
+                if target is None:
+                    continue
+                position = self.axes[i].position(t)
+                self.axes[i].start(position, np.clip(target, -PULSE_LIMIT, PULSE_LIMIT), t, self.speeds[i])
+
+    def stop(self):
+        t = time.time()
+        with self.lock:
+            for axis in self.axes:
+                position = axis.position(t)
+                axis.start(position, position, t, (1, 1, 1))
+
+    def handle(self, order: str) -> str:
+        self.num_commands += 1
+        command, _, args = order.partition(':')
+        args = args.split(',') if args else []
+        try:
+            if command == 'Q':
+                return ','.join(str(int(round(p))) for p in self.get_position())
+            if command == '!':
+                return 'B' if self.is_busy() else 'R'
+            if command == 'A':
+                self.move([float(a) for a in args])
+                return 'OK'
+            if command == 'K':
+                # 1,2,3に続けて各軸の相対移動量
+                position = self.get_position()
+                self.move([p + float(a) for p, a in zip(position, args[3:])])
+                return 'OK'
+            if command == 'J':
+                sign = {'+': 1, '-': -1}
+                self.move([sign[a] * PULSE_LIMIT if a in sign else None for a in args])
+                return 'OK'
+            if command == 'D':
+                axis, start, final, rate = [int(a) for a in args]
+                self.speeds[axis - 1] = (start, final, rate)
+                return 'OK'
+            if command == 'L':
+                self.stop()
+                return 'OK'
+            if command == '?':
+                return self.query(args[0])
+        except (ValueError, IndexError, KeyError):
+            pass
+        return 'NG'
+
+    def query(self, item: str) -> str:
+        if item == 'N':
+            return 'HSC-103'
+        if item == 'V':
+            return 'V1.00'
+        if item == 'P':
+            return ','.join(str(int(round(p))) for p in self.get_position())
+        if item[0] == 'D':
+            return ','.join(str(v) for v in self.speeds[int(item[1:]) - 1])
+        if item[0] == 'B':
+            return '0'
+        return 'NG'
+
+
+def main():
+    import serial
+    from HSC103Controller import HSC103Controller
+
+    stage = VirtualHSC103()
+    ser = serial.Serial(stage.port, 38400, timeout=1)
+    hsc = HSC103Controller(ser, poll_interval=0.05)
+    hsc.set_speed_all([10000, 100000, 100])
+    t = time.time()
+    hsc.move_abs([100000, 50000, 0])
+    hsc.wait_until_ready(settle=0)
+    print(f'moved to {hsc.query_position().result()} in {time.time() - t:.3f} s')
+    hsc.close()
+    stage.close()
+
+
+if __name__ == '__main__':
+    main()
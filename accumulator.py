@@ -0,0 +1,99 @@
+import numpy as np
+
+
+class SpectrumAccumulator:
+    """
+    1点分のフレームを確保済みのバッファに溜め，単純な和・スパイクを除いた和・画素ごとの分散を求める．
+    宇宙線は1枚のフレームにしか乗らないので，フレーム間の中央値から大きく外れた値を中央値で置き換えてから足す．
+    バッファはすべて最初に確保し，フレームの追加や計算では新しい配列を作らない．
+    """
+    def __init__(self, xpixels: int, max_frames: int, threshold: float = 5):
+        self.xpixels = xpixels
+        self.max_frames = max_frames
+        self.threshold = threshold  # 何σ外れたらスパイクとみなすか
+        self.num = 0
+
+        self.frames = np.zeros((max_frames, xpixels))
+        self.cleaned = np.zeros((max_frames, xpixels))  # スパイクを置き換えたフレーム
+        self.deviation = np.zeros((max_frames, xpixels))
+        self.mask = np.zeros((max_frames, xpixels), dtype=bool)
+        self.median = np.zeros(xpixels)
+        self.sigma = np.zeros(xpixels)
+        self.sum = np.zeros(xpixels)
+        self.clipped_sum = np.zeros(xpixels)
+        self.variance = np.zeros(xpixels)
+        self.num_rejected = 0
+        self.mean = np.zeros(xpixels)
+        self.residual = np.zeros(xpixels)
+
+    def reset(self):
+        self.num = 0
+
+    def add(self, frame):
+        if self.num >= self.max_frames:
+            raise ValueError('accumulator is full')
+        np.copyto(self.frames[self.num], frame)
+        self.num += 1
+
+    def add_series(self, data):
+        # 連続撮影でまとめて読み出したデータ(フレーム数×画素数)を入れる
+        num = np.size(data) // self.xpixels
+        if self.num + num > self.max_frames:
+            raise ValueError('accumulator is full')
+        np.copyto(self.frames[self.num:self.num + num], np.reshape(data, (num, self.xpixels)))
+        self.num += num
+
+    def snr(self, region=slice(None)):
+        """
+        これまでのフレームを足したときの指定範囲のSN比．
+        信号は範囲内の平均の和，雑音はフレーム間のばらつきから求めた和の標準偏差．
+        Args:
+            region (slice): 評価する画素の範囲．
+
+        Returns:
+            snr (float): 2枚未満ではばらつきが分からないので0．
+        """
+        n = self.num
+        if n < 2:
+            return 0.0
+        frames = self.frames[:n, region]
+        mean = self.mean[region]
+        residual = self.residual[region]
+        np.mean(frames, axis=0, out=mean)
+        noise = 0.0
+        for frame in frames:
+            np.subtract(frame, mean, out=residual)
+            noise += np.dot(residual, residual)
+        noise = np.sqrt(noise / (n - 1) * n)  # 和の分散は1枚の分散のn倍
+        if noise == 0:
+            return np.inf
+        return float(mean.sum() * n / noise)
+
+    def compute(self):
+        n = self.num
+        frames = self.frames[:n]
+        cleaned = self.cleaned[:n]
+        deviation = self.deviation[:n]
+        mask = self.mask[:n]
+
+        np.sum(frames, axis=0, out=self.sum)
+        np.copyto(cleaned, frames)
+        if n >= 3:  # 中央値で外れ値を判定できるのは3枚以上
+            np.median(frames, axis=0, out=self.median)
+            np.subtract(frames, self.median, out=deviation)
+            # 中央絶対偏差から求めたσ．フレームが揃いすぎている場合はショットノイズで下限をつける
+            np.abs(deviation, out=cleaned)
+            np.median(cleaned, axis=0, out=self.sigma)
+            self.sigma *= 1.4826
+            np.maximum(self.sigma, np.sqrt(np.abs(self.median)), out=self.sigma)
+            np.maximum(self.sigma, 1, out=self.sigma)
+            self.sigma *= self.threshold
+            np.greater(deviation, self.sigma, out=mask)  # 宇宙線は正の方向にだけ出る
+            self.num_rejected = int(np.count_nonzero(mask))
+            np.copyto(cleaned, frames)
+            np.copyto(cleaned, np.broadcast_to(self.median, cleaned.shape), where=mask)
+        else:
+            self.num_rejected = 0
+        np.sum(cleaned, axis=0, out=self.clipped_sum)
+        np.var(cleaned, axis=0, out=self.variance)
+        return self.clipped_sum
@@ -0,0 +1,146 @@
+import glob
+import io
+import os
+import re
+import numpy as np
+
+CACHE_NAME = '.asc_cache.npz'  # 読み込み済みの値を残すファイル．データと同じフォルダに置く
+NUMBER_PATTERN = re.compile(r'(\d+)\s*of\s*(\d+)')
+
+
+def sort_key(filename: str):
+    """
+    {番号}of{点数}.asc を番号順に並べるためのキー．番号の前後に文字が付いていてもよい．
+    キャリブレーションのファイルは先頭，番号の読めないファイルは末尾に名前順で並べる．
+    """
+    name = os.path.basename(filename)
+    if 'calibration' in name:
+        return 0, 0, name
+    matches = NUMBER_PATTERN.findall(name)
+    if not matches:
+        return 2, 0, name
+    return 1, int(matches[-1][0]), name
+
+
+def find_asc_files(path: str):
+    filenames = glob.glob(os.path.join(path, '*.asc'))
+    filenames.sort(key=sort_key)
+    return filenames
+
+
+def parse_one(content: bytes):
+    import pandas as pd
+    try:
+        return pd.read_csv(io.BytesIO(content), header=None, dtype=np.float64).values.ravel()
+    except (ValueError, pd.errors.EmptyDataError):
+        return np.zeros(0)  # 読めないファイルは空として扱う
+
+
+def parse_asc(contents: list):
+    """
+    複数の.ascの中身をつなげて1回で数値に変換する．
+    Args:
+        contents (list(bytes)): 各ファイルの中身．1行に1つの値．
+
+    Returns:
+        values (list(np.ndarray)): 各ファイルの値．読めなかったファイルは長さ0．
+    """
+    import pandas as pd  # Cで書かれた読み込みが速いので使う．importは読むときだけ
+    contents = [content.strip() + b'\n' if content.strip() else b'' for content in contents]
+    counts = [content.count(b'\n') for content in contents]
+    if sum(counts) == 0:
+        return [np.zeros(0) for _ in contents]
+    try:
+        values = pd.read_csv(io.BytesIO(b''.join(contents)), header=None, dtype=np.float64).values.ravel()
+    except ValueError:
+        values = None
+    if values is None or len(values) != sum(counts):
+        # 1列でないファイルや空行が混じっている場合は1つずつ読む
+        return [parse_one(content) for content in contents]
+    return np.split(values, np.cumsum(counts)[:-1])
+
+
+def read_files(filenames: list):
+    contents = []
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            contents.append(f.read())
+    return parse_asc(contents)
+
+
+def read_cache(cache_path: str):
+    """
+    Returns:
+        cached (dict): {ファイル名: (更新時刻 [ns], 大きさ [byte], 値)}．
+        pixels (int): 画素数．キャッシュがなければNone．
+    """
+    try:
+        with np.load(cache_path, allow_pickle=False) as npz:
+            names = npz['names'].tolist()
+            mtimes = npz['mtimes']
+            sizes = npz['sizes']
+            data = npz['data']
+    except (OSError, ValueError, KeyError):
+        return {}, None
+    cached = {name: (int(mtimes[i]), int(sizes[i]), data[i]) for i, name in enumerate(names)}
+    return cached, data.shape[1]
+
+
+def write_cache(cache_path: str, names: list, stats: dict, data: np.ndarray):
+    # 書きかけのキャッシュが残らないよう別名で書いてから置き換える
+    tmp_path = cache_path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, names=np.array(names, dtype=str), data=data,
+                     mtimes=np.array([stats[name][0] for name in names], dtype=np.int64),
+                     sizes=np.array([stats[name][1] for name in names], dtype=np.int64))
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(f'Failed in writing cache: {e}')
+
+
+def load_asc_folder(path: str, use_cache: bool = True):
+    """
+    フォルダ内の.ascを番号順に読み，1つの配列にまとめる．
+    読んだ値はファイル名・更新時刻・大きさとともにフォルダ内のキャッシュに残し，次からは新しいか変わったファイルだけを読む．
+    測定中のフォルダを読み直してもよい．書きかけで画素数に足りないファイルは飛ばし，次に読むときに読み直す．
+    Args:
+        path (str): .ascの入ったフォルダ．
+        use_cache (bool): キャッシュを使うか．
+
+    Returns:
+        filenames (list(str)): 読んだファイル名．キャリブレーションのファイルが先頭．
+        data (np.ndarray): (ファイル数, 画素数)の配列．
+    """
+    stats = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.endswith('.asc') and entry.is_file():
+                stat = entry.stat()
+                stats[entry.name] = (stat.st_mtime_ns, stat.st_size)
+    names = sorted(stats, key=sort_key)
+
+    cache_path = os.path.join(path, CACHE_NAME)
+    cached, pixels = read_cache(cache_path) if use_cache else ({}, None)
+    rows = {}
+    changed = [name for name in names if name not in cached or cached[name][:2] != stats[name]]
+    for name in set(names).difference(changed):
+        rows[name] = cached[name][2]
+    for name, values in zip(changed, read_files([os.path.join(path, name) for name in changed])):
+        rows[name] = values
+
+    if pixels is None:
+        lengths = [len(values) for values in rows.values() if len(values) > 0]
+        pixels = int(np.bincount(lengths).argmax()) if lengths else 1024
+    skipped = [name for name in names if len(rows[name]) != pixels]
+    if skipped:
+        print(f'{len(skipped)} files are incomplete or unreadable and skipped: {skipped[:5]}')
+    names = [name for name in names if len(rows[name]) == pixels]
+    loaded = set(names)
+
+    data = np.empty((len(names), pixels))
+    for i, name in enumerate(names):
+        data[i] = rows[name]
+    if use_cache and (not loaded.isdisjoint(changed) or set(cached) != loaded):
+        write_cache(cache_path, names, stats, data)
+    return [os.path.join(path, name) for name in names], data
@@ -0,0 +1,80 @@
+import time
+import serial
+import numpy as np
+from HSC103Controller import HSC103Controller
+from VirtualHSC103 import VirtualHSC103
+from VirtualCamera import VirtualCamera
+from EmptySdk import atmcd_codes
+from scan_plan import ScanPlan
+
+
+def measure_latency(hsc: HSC103Controller, number: int = 200):
+    # Q:を送ってから返答を受け取るまでの時間
+    latencies = np.zeros(number)
+    for i in range(number):
+        t = time.perf_counter()
+        hsc.request('Q:')
+        latencies[i] = time.perf_counter() - t
+    return latencies
+
+
+def measure_line_scan(hsc: HSC103Controller, sdk: VirtualCamera, plan: ScanPlan, settle: float):
+    """
+    ステップごとに止めて1枚撮るスキャンを行い，移動と撮影にかかった時間を点ごとに記録する．
+    Returns:
+        t_move (np.ndarray): 移動命令から到着確認までの時間 [s]．
+        t_acquire (np.ndarray): 撮影開始から読み出し終了までの時間 [s]．
+    """
+    t_move = np.zeros(len(plan))
+    t_acquire = np.zeros(len(plan))
+    sdk.SetAcquisitionMode(atmcd_codes.Acquisition_Mode.SINGLE_SCAN)
+    for i, point in enumerate(plan):
+        t = time.perf_counter()
+        hsc.move_abs(point)
+        hsc.wait_until_ready(settle=settle)
+        t_move[i] = time.perf_counter() - t
+        t = time.perf_counter()
+        sdk.handle_return(sdk.StartAcquisition())
+        sdk.handle_return(sdk.WaitForAcquisition())
+        ret, spec, first, last = sdk.GetImages16(1, 1, sdk.xpixels)
+        sdk.handle_return(ret)
+        t_acquire[i] = time.perf_counter() - t
+    return t_move, t_acquire
+
+
+def summarize(name: str, values):
+    values = np.asarray(values) * 1000
+    print(f'{name}: mean {values.mean():.2f} ms, median {np.median(values):.2f} ms, max {values.max():.2f} ms')
+
+
+def main():
+    exposure_time = 0.05
+    steps = 20
+    settle = 0.05
+
+    stage = VirtualHSC103()
+    sdk = VirtualCamera(stage)
+    ser = serial.Serial(stage.port, 38400, timeout=1, write_timeout=0)
+    hsc = HSC103Controller(ser, poll_interval=0.2)
+    sdk.SetExposureTime(exposure_time)
+
+    summarize('Q: round trip', measure_latency(hsc))
+
+    for future in hsc.set_speed_max():
+        future.result()
+    plan = ScanPlan.line([0, 0, 0], [2000, 1000, 0], steps)  # 20μm×10μm
+    t = time.perf_counter()
+    t_move, t_acquire = measure_line_scan(hsc, sdk, plan, settle)
+    elapsed = time.perf_counter() - t
+    summarize('move + settle', t_move)
+    summarize('acquisition', t_acquire)
+    print(f'line scan: {steps} points in {elapsed:.2f} s, {steps / elapsed:.2f} points/s '
+          f'(exposure {exposure_time * steps / elapsed * 100:.0f}% of time)')
+
+    hsc.close()
+    ser.close()
+    stage.close()
+
+
+if __name__ == '__main__':
+    main()
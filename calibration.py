@@ -1,13 +1,80 @@
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-from scipy.signal import find_peaks
-from sklearn.linear_model import LinearRegression
-from sklearn.preprocessing import PolynomialFeatures
-from sklearn.metrics import r2_score
 
-PEAKS = [435.8335, 546.0750, 576.9610, 579.0670, 696.5431, 706.7218, 714.7042, 727.2936, 738.3980, 750.3869, 751.4652,
-         763.5106, 772.3761, 794.8176, 800.6157, 801.4786, 810.3693, 811.5311]
+# 校正用ランプ(Hg-Ar)の輝線 [nm]．窓に入る線は中心波長から自動で選ぶので，ここに足せば使える
+PEAKS = [404.6565, 407.7837, 435.8335, 546.0750, 576.9610, 579.0670, 667.7282, 675.2834, 687.1289, 696.5431, 706.7218,
+         714.7042, 727.2936, 738.3980, 750.3869, 751.4652, 763.5106, 772.3761, 794.8176, 800.6157, 801.4786, 810.3693,
+         811.5311, 826.4522, 840.8210, 842.4648, 852.1442]
+HALF_WIDTH = 65  # 中心波長から窓の端までの幅 [nm]
+WINDOW_MARGIN = 5  # 窓の外でもこれだけ近い線は校正でずれて入りうるので候補にする [nm]
+MAX_DEGREE = 3  # 何次方程式でフィッティングするか．使える線が少なければ下げる
+PROMINENCE = 40  # ピークとみなす突出度 [count]
+PEAK_DISTANCE = 5  # ピーク同士の最小の間隔 [pixel]
+INTENSITY_WEIGHT = 0.5  # 対応づけで大きいピークを優先する度合い
+VERSION = 3  # 校正の手順を変えて結果が変わるときに上げる．CalibrationCacheの古い結果を使わないため
+
+
+def fit_polynomial(x, y, degree: int):
+    """
+    最小二乗法で多項式を当てはめる．sklearnのPolynomialFeatures + LinearRegressionと同じ解を返す．
+    説明変数を中心化してから解くので，点の数が係数より少ない場合もLinearRegressionと同じく最小ノルム解になる．
+    Args:
+        x (np.ndarray): 校正前の波長．
+        y (np.ndarray): 対応する正しい波長．
+        degree (int): 多項式の次数．
+
+    Returns:
+        coefficients (np.ndarray): np.polyvalの順(高次から)の係数．
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    features = np.vander(x, degree + 1, increasing=True)[:, 1:]  # x, x^2, ...
+    features_mean = features.mean(axis=0)
+    y_mean = y.mean()
+    coef = np.linalg.lstsq(features - features_mean, y - y_mean, rcond=None)[0]
+    intercept = y_mean - features_mean @ coef
+    return np.concatenate([coef[::-1], [intercept]])
+
+
+def match_lines(x_found, heights, lines, search_width: float = 4, intensity_weight: float = INTENSITY_WEIGHT):
+    """
+    検出したピークと輝線の表を1対1に対応づける．距離が近く，大きいピークほど選ばれやすい割り当てをまとめて解く．
+    距離は2乗で評価するので，750/751 nmや800/801 nmのように近い2本と2つのピークは必ず波長の順に対応し，入れ替わらない．
+    (距離そのものだと，2つのピークが2本の線の同じ側にずれているときに入れ替えても合計が変わらない)
+    Args:
+        x_found (np.ndarray): 検出したピークの校正前の波長．
+        heights (np.ndarray): ピークの高さ．
+        lines (np.ndarray): 輝線の波長．
+        search_width (float): これより離れたピークと線は対応づけない [nm]．
+        intensity_weight (float): 大きいピークを優先する度合い．
+
+    Returns:
+        peak_indices (np.ndarray): 対応づいたピークの番号(x_foundの添字)．波長の順．
+        line_indices (np.ndarray): 対応する線の番号(linesの添字)．
+    """
+    from scipy.optimize import linear_sum_assignment
+    x_found = np.asarray(x_found, dtype=float)
+    lines = np.asarray(lines, dtype=float)
+    if x_found.size == 0 or lines.size == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    heights = np.asarray(heights, dtype=float)
+    distance = np.abs(x_found[:, None] - lines[None, :])  # (ピーク, 線)
+    cost = (distance / search_width) ** 2 - intensity_weight * (heights / heights.max())[:, None]
+    allowed = distance <= search_width
+    cost[~allowed] = cost.max() + x_found.size + lines.size  # 範囲外は選ばれないよう大きくする
+    peak_indices, line_indices = linear_sum_assignment(cost)
+    keep = allowed[peak_indices, line_indices]
+    peak_indices, line_indices = peak_indices[keep], line_indices[keep]
+    order = np.argsort(lines[line_indices])
+    return peak_indices[order], line_indices[order]
+
+
+def r2_score(y_true, y_pred):
+    y_true = np.asarray(y_true, dtype=float)
+    ss_res = np.sum((y_true - y_pred) ** 2)
+    ss_tot = np.sum((y_true - y_true.mean()) ** 2)
+    if ss_tot == 0:
+        return 1.0 if ss_res == 0 else 0.0
+    return 1 - ss_res / ss_tot
 
 
 class Calibrator:
@@ -15,14 +82,18 @@ class Calibrator:
         self.center = 630
         self.peaks_target = []
         self.df = None
-        self.pf = None
+        self.degree = None
         self.x = None
         self.y = None
         self.indices_detected = None
+        self.peaks_matched = None  # 検出したピークに対応づけた線
+        self.coefficients = None  # 校正前の波長に対する多項式の係数(np.polyvalの順，高次から)
+        self.r2 = None
 
     def load_data_from_path(self, path: str):
         if path.split('.')[-1] != 'asc':
             print('This program supports asc file.')
+        import pandas as pd  # 読み込むときだけ使う
         filename = path
         self.df = pd.read_csv(filename, delimiter='\t', header=None)
 
@@ -31,120 +102,88 @@ class Calibrator:
         if len(arr) != 1024:
             print('Wrong shape. Check the input array.')
             print(arr)
+        import pandas as pd
         self.df = pd.DataFrame(data=arr)
 
     def set_center(self, center: float):
-        if center not in [500, 630, 760]:
-            print('This program supports 500, 630 or 760 nm as center wavelength.')
-            return False
+        """
+        窓に入りうる線をすべて候補にする．2本未満では校正できないので，calibrateはFalseを返す．
+        Returns:
+            ok (bool): 校正に使える線があったか．
+        """
+        lines = np.array(PEAKS)
+        in_window = np.abs(lines - center) <= HALF_WIDTH + WINDOW_MARGIN
         self.center = center
-        degree = 3  # 何次方程式でフィッティングするか
-        if self.center == 500:
-            self.peaks_target = PEAKS[:2]
-            degree = 1
-        elif self.center == 630:
-            self.peaks_target = PEAKS[2:5]
-        elif self.center == 760:
-            self.peaks_target = PEAKS[4:]
-
-        self.pf = PolynomialFeatures(degree=degree)
+        if np.count_nonzero(in_window) < 2:
+            print(f'Less than two calibration lines around {center} nm. Add lines to PEAKS.')
+            self.peaks_target = []
+            self.degree = None
+            return False
+        self.peaks_target = lines[in_window].tolist()
+        self.degree = min(MAX_DEGREE, len(self.peaks_target) - 1)
+        return True
+
+    def get_settings(self, search_width=4):
+        # 校正の結果を左右する設定．CalibrationCacheのキーに使う
+        return {
+            'version': VERSION,
+            'search_width': search_width,
+            'peaks': list(self.peaks_target),
+            'degree': self.degree,
+            'half_width': HALF_WIDTH,
+            'prominence': PROMINENCE,
+            'distance': PEAK_DISTANCE,
+            'intensity_weight': INTENSITY_WEIGHT,
+        }
 
     def calibrate(self, search_width=4):
-        self.x = np.linspace(self.center - 65, self.center + 65, self.df.shape[0])
+        if self.degree is None:
+            print('Calibration lines are not set. Call set_center with a center that has two or more lines.')
+            return False
+        from scipy.signal import find_peaks
+        self.x = np.linspace(self.center - HALF_WIDTH, self.center + HALF_WIDTH, self.df.shape[0])
         self.y = np.ravel(self.df.values)
-        indices_found, _ = find_peaks(self.y, prominence=40, distance=5)
-
-        self.indices_detected = []
-        x_found = self.x[indices_found]
-        for i, peak_target in enumerate(self.peaks_target):
-            if self.center == 760 and i in [5, 6, 10, 11, 12, 13, 14]:
-                if i == 14:  # リスト末尾の0
-                    continue
-                else:  # 750付近、800付近、810付近では注意が必要
-                    index_detected = self.process_760(i, indices_found, search_width=search_width)
-            else:
-                diff_array = np.abs(x_found - peak_target) - self.y[indices_found] * 0.001  # ピークの大きさで重みづけ．近くにあって，大きいピークを選ぶように
-                index_detected = indices_found[diff_array == np.min(diff_array)]
-            self.indices_detected += list(index_detected)
-
-        self.indices_detected = sorted(list(set(self.indices_detected)))  # 重複削除
-
-        if len(self.indices_detected) != len(self.peaks_target):
+        indices_found, _ = find_peaks(self.y, prominence=PROMINENCE, distance=PEAK_DISTANCE)
+
+        peak_indices, line_indices = match_lines(self.x[indices_found], self.y[indices_found], self.peaks_target, search_width)
+        self.indices_detected = indices_found[peak_indices].tolist()
+        self.peaks_matched = [self.peaks_target[i] for i in line_indices]
+
+        if len(self.indices_detected) < 2:
             print('Some peaks not detected. Check graph')
             return False
+        missing = sorted(set(self.peaks_target) - set(self.peaks_matched))
+        if missing:
+            print(f'Not detected: {missing}')
 
         print('\nキャリブレーションに使用するピーク: ')
         print('校正前\t->\t校正後')
-        for i, index in enumerate(self.indices_detected):
-            print(f'{round(self.x[index], 2)}\t->\t{round(self.peaks_target[i], 2)}')
+        for index, peak in zip(self.indices_detected, self.peaks_matched):
+            print(f'{round(self.x[index], 2)}\t->\t{round(peak, 2)}')
         print()
 
-        x_detected_t = self.x[self.indices_detected].reshape(self.x[self.indices_detected].size, 1)  # 特徴量ベクトルを転置
-        x_detected_cubic = self.pf.fit_transform(x_detected_t)
-
-        model = LinearRegression()  # 線形回帰
-        model.fit(x_detected_cubic, self.peaks_target)
+        x_detected = self.x[self.indices_detected]
+        degree = min(self.degree, len(x_detected) - 1)  # 見つかった線が少なければ次数を下げる
+        self.coefficients = fit_polynomial(x_detected, self.peaks_matched, degree)  # 線形回帰
 
         print('-' * 50)
-        print(f'回帰モデルの係数: {model.coef_}')
-        peaks_pred = model.predict(x_detected_cubic)
-        print(f'回帰モデルのスコア: {r2_score(self.peaks_target, peaks_pred)}')
+        print(f'回帰モデルの係数: {self.coefficients}')
+        peaks_pred = np.polyval(self.coefficients, x_detected)
+        self.r2 = r2_score(self.peaks_matched, peaks_pred)
+        print(f'回帰モデルのスコア: {self.r2}')
         print('-' * 50)
 
-        x_t = self.x.reshape(self.x.size, 1)
-        x_cubic = self.pf.fit_transform(x_t)
-        x_calibrated = model.predict(x_cubic)
+        x_calibrated = np.polyval(self.coefficients, self.x)
 
         return x_calibrated
 
-    def process_760(self, i: int, indices_found: np.ndarray, search_width :int = 4):
-        peak_target = self.peaks_target[i]
-
-        indices_around_target = np.array([])
-        for index_found in indices_found:
-            peak_found = self.x[index_found]
-            diff = abs(peak_target - peak_found)
-            if diff < search_width:
-                indices_around_target = np.append(indices_around_target, index_found)
-
-        indices_detected = []
-        indices_around_target = list(indices_around_target.astype(int))
-
-        if i in [5, 6]:  # 750付近
-            if len(indices_around_target) in [1, 2]:
-                indices_detected = indices_around_target  # 重複は許す
-            elif len(indices_around_target) == 3:
-                y_values = self.y[indices_around_target]  # ピークとして検出されたyの値
-                y_values_sorted = y_values.sort()  # 昇順にソート
-                index_750 = indices_around_target[y_values == y_values_sorted[2]][0]  # 一番大きいピークは750.3869
-                index_751 = indices_around_target[y_values == y_values_sorted[1]][0]  # 二番目は751.465
-                indices_detected = [index_750, index_751]  # 重複は許す
-            else:
-                print(f'Peak detection error at around {peak_target} nm')
-
-        elif i in [10, 11]:  # 800付近
-            if len(indices_around_target) == 2:  # 1番目、2番目のピークを800, 801に
-                indices_detected = indices_around_target
-            else:
-                print(f'Peak detection error at around {peak_target} nm')
-
-        elif i in [12, 13]:  # 810付近
-            if len(indices_around_target) == 3:
-                indices_detected = indices_around_target[1:]  # 2番目、3番目のピークを810, 811に
-            else:
-                print(f'Peak detection error at around {peak_target} nm')
-
-        if len(indices_detected) == 0:
-            print(f'No peaks detected for {peak_target} nm')
-
-        return indices_detected
-
     def show_result(self):
+        import matplotlib.pyplot as plt
         fig, ax = plt.subplots()
         ax.plot(self.x, self.y, color='k')
         ax.scatter(self.x[self.indices_detected], self.y[self.indices_detected], marker='x', color='r')
-        for i, peak_target in enumerate(self.peaks_target):
-            ax.text(self.x[self.indices_detected[i]], self.y[self.indices_detected[i]], peak_target)
+        for index, peak in zip(self.indices_detected, self.peaks_matched):
+            ax.text(self.x[index], self.y[index], peak)
         ax.set_title('Peaks detected as')
         plt.show()
 
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.autorayleigh', 'calibration_cache.json')
+MAX_ENTRIES = 100
+MAX_AGE = 90 * 24 * 3600  # 最後に使ってからこれ以上経った校正は捨てる [s]
+
+
+def nominal_axis(center: float, pixels: int):
+    # 校正前の波長軸．Calibratorと同じ
+    return np.linspace(center - 65, center + 65, pixels)
+
+
+class CalibrationCache:
+    """
+    校正の結果(多項式の係数，使ったピーク，当てはまりの良さ)をJSONファイルに残す．
+    キーはキャリブレーション用スペクトルのハッシュ，中心波長，校正の設定と手順の版(Calibrator.get_settings)から作るので，
+    同じファイルを2回校正することはなく，手順や設定を変えれば古い結果は使われない．
+    残っていればピーク検出も回帰も行わず，校正前の波長軸に多項式を当てはめるだけで波長軸を返す．
+    件数がmax_entriesを超えたら使っていない順に，max_ageより古いものは期限切れとして捨てる．
+    """
+    def __init__(self, path: str = None, max_entries: int = MAX_ENTRIES, max_age: float = MAX_AGE):
+        self.path = DEFAULT_PATH if path is None else path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        # 別のプロセスが読んでも壊れていないよう，別名で書いてから置き換える
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f'Failed in saving calibration cache: {e}')
+
+    @staticmethod
+    def make_key(spectrum, center: float, settings: dict):
+        h = hashlib.sha256(np.ascontiguousarray(spectrum, dtype=np.float64).tobytes())
+        h.update(json.dumps(dict(settings, center=float(center)), sort_keys=True).encode())
+        return h.hexdigest()
+
+    def evict(self, now: float = None):
+        now = time.time() if now is None else now
+        for key in [key for key, entry in self.entries.items() if now - entry['last_used'] > self.max_age]:
+            del self.entries[key]
+        if len(self.entries) > self.max_entries:
+            keys = sorted(self.entries, key=lambda key: self.entries[key]['last_used'])
+            for key in keys[:len(self.entries) - self.max_entries]:
+                del self.entries[key]
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry['last_used'] > self.max_age:
+            return None
+        entry['last_used'] = time.time()
+        self.save()
+        return entry
+
+    def put(self, key: str, entry: dict):
+        now = time.time()
+        self.entries[key] = dict(entry, created=now, last_used=now)
+        self.evict(now)
+        self.save()
+
+    def calibrate(self, clb, search_width: int = 4, show: bool = False):
+        """
+        clbに読み込んだスペクトルで校正する．同じスペクトル・中心波長・設定の結果が残っていればそれを使う．
+        Args:
+            clb (Calibrator): キャリブレーション用のスペクトルと中心波長を設定したもの．
+            search_width (int): Calibrator.calibrateに渡す幅．
+            show (bool): 校正をやり直して結果を表示するか．
+
+        Returns:
+            x_calibrated (np.ndarray): 校正後の波長軸．校正できなければFalse．
+        """
+        spectrum = np.ravel(clb.df.values)
+        key = self.make_key(spectrum, clb.center, clb.get_settings(search_width))
+        entry = None if show else self.get(key)
+        if entry is not None:
+            return np.polyval(entry['coefficients'], nominal_axis(clb.center, len(spectrum)))
+
+        x_calibrated = clb.calibrate(search_width=search_width)
+        if show:
+            clb.show_result()
+        if x_calibrated is False:
+            return False
+        self.put(key, {
+            'center': clb.center,
+            'coefficients': clb.coefficients.tolist(),
+            'peaks_pixel': [int(i) for i in clb.indices_detected],
+            'peaks_target': list(clb.peaks_matched),
+            'r2': clb.r2,
+        })
+        return x_calibrated
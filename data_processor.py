@@ -1,40 +1,67 @@
-import glob
 import os.path
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
 from calibration import Calibrator
-from mayavi import mlab
+from calibration_cache import CalibrationCache
+from scan_file import ScanFile
+from spike_removal import modified_z_score, fixed_z, fixed_z_batch
+from spectrum_stack import SpectrumStack, CHUNK_SIZE
+from asc_loader import find_asc_files, load_asc_folder, read_files
 
 
-def modified_z_score(intensity):
-    median_int = np.median(intensity)
-    mad_int = np.median([np.abs(intensity - median_int)])
-    modified_z_scores = 0.6745 * (intensity - median_int) / mad_int
-    return modified_z_scores
+def position_order(scan: ScanFile):
+    # Adaptiveのスキャンは測定順ではなくstartからの位置の順に並べる．それ以外はNone
+    if scan.settings.get('plan') != 'adaptive':
+        return None
+    return np.argsort(np.linalg.norm(scan.positions - scan.positions[0], axis=1), kind='stable')
 
 
-def fixed_z(y, m):
-    threshold = 7  # 閾値
-    spikes = abs(np.array(modified_z_score(np.diff(y)))) > threshold
-    y_out = y.copy()
-    for i in np.arange(len(spikes)):
-        if spikes[i]:  # If we have a spike in position i
-            w = np.arange(i - m, i + 1 + m)  # スパイク周りの2 m + 1個のデータを取り出す
-            w = w[0 <= w]  # 範囲を超えないようトリミング
-            w = w[w < 1023]
-            w2 = w[spikes[w] == False]  # スパイクでない値を抽出し，
-            if len(w2) > 0:
-                y_out[i] = np.mean(y[w2])  # 平均を計算し補完
+class RunningStats:
+    """
+    データを少しずつ受け取りながら全体の平均と標準偏差を求める．
+    Welford法を塊ごとの平均と偏差平方和の合成に広げたもので，全体をメモリに載せる必要がない．
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # 平均からの偏差の2乗和
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk, dtype=float)
+        if chunk.size == 0:
+            return
+        mean = chunk.mean()
+        self.merge(chunk.size, mean, np.square(chunk - mean).sum())
+
+    def merge(self, n: int, mean: float, m2: float):
+        # 別に集計した(点数, 平均, 偏差平方和)を合わせる
+        if n == 0:
+            return
+        delta = mean - self.mean
+        total = self.n + n
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.n * n / total
+        self.n = total
 
-    return y_out
+    @property
+    def std(self):
+        # np.stdと同じく母標準偏差
+        if self.n == 0:
+            return 0.0
+        return np.sqrt(self.m2 / self.n)
 
 
 class DataProcessor:
-    def __init__(self):
-        self.df = None
-        self.df_without_cosmic_ray = None
+    """
+    スペクトルはSpectrumStack(1つの(点数, 画素数)の配列)で持ち，宇宙線除去はその場で書き換える．
+    元のデータを残したい場合は宇宙線除去の前にstack.data.copy()を取っておく．
+    """
+    def __init__(self, dtype=np.float64, cache_path: str = None):
+        self.dtype = dtype  # np.float32にするとメモリが半分になる
+        self.cache_path = cache_path  # 校正結果を残すファイル(config.jsonのCALIBRATION_CACHE)．Noneなら既定の場所
+        self.stack = None
+        self.cosmic_ray_removed = 0  # 宇宙線除去をかけた回数
         self.num_data = 0
         self.wl_data = None
         self.peaks_found_wl = None
@@ -42,64 +69,140 @@ class DataProcessor:
 
         self.clb = None
 
-    def load_data(self, path: str, center: float):
-        self.wl_data = np.linspace(center - 65, center + 65, 1024)
+    def set_calibrator(self, center: float, pixels: int = 1024):
+        # 校正に使える線がない中心波長でも読み込みは続け，校正前の波長軸を使う
+        self.wl_data = np.linspace(center - 65, center + 65, pixels)
         self.clb = Calibrator()
-        self.clb.set_center(center)
+        if not self.clb.set_center(center):
+            print('The nominal wavelength axis is used.')
+            return False
+        return True
 
-        if isinstance(path, str):
-            filenames = glob.glob(path + '/*.asc')
-        else:
+    def load_data(self, path: str, center: float, use_cache: bool = True):
+        self.set_calibrator(center)
+
+        if not isinstance(path, str) or not os.path.isdir(path):
             print('Failed in loading data. Check the path.')
             return False
 
-        def sort_key(fn):
-            fn_sep = fn.split(os.path.sep)[-1]
-            if 'calibration' in fn_sep:
-                return -1
-            fn_sep = fn_sep.strip('acquisition')
-            fn_sep = fn_sep[:fn_sep.find('of')]
-            return int(fn_sep) + 1
-        filenames.sort(key=sort_key)
-
-        df_list = []
-        for filename in filenames:
-            df = pd.read_csv(filename, header=None).T
-            filename_split = filename.split(os.path.sep)[-1]
-            if 'calibration' in filename_split:
-                self.clb.load_data_from_array(df.values)
+        # キャリブレーションのファイルは先頭に並ぶので，残りはビューのまま使う
+        filenames, data = load_asc_folder(path, use_cache=use_cache)
+        names = [filename.split(os.path.sep)[-1] for filename in filenames]
+        num_calibration = sum('calibration' in name for name in names)
+        for row in data[:num_calibration]:
+            self.clb.load_data_from_array(row)
+        self.stack = SpectrumStack(data[num_calibration:], wavelength=self.wl_data, names=names[num_calibration:], dtype=self.dtype)
+        self.cosmic_ray_removed = 0
+        self.num_data += len(self.stack)
+
+    def load_scan(self, path: str, center: float, calibration_path: str = None):
+        # スキャンファイルをmemmapで開く．並べ替えがなければ宇宙線除去まではコピーしない
+        # キャリブレーションのファイルを指定しなければ，測定時にジョブで指定したものを使う
+        self.set_calibrator(center)
+
+        scan = ScanFile.open(path)
+        if calibration_path is not None:
+            self.clb.load_data_from_path(calibration_path)
+        else:
+            self.load_recorded_calibration(scan.settings)
+        self.stack = SpectrumStack.from_scan(scan, wavelength=self.wl_data, order=position_order(scan), dtype=self.dtype)
+        self.cosmic_ray_removed = 0
+        self.num_data += len(scan)
+        return scan
+
+    def load_calibration(self, path: str, center: float, pixels: int = 1024):
+        """
+        窓のキャリブレーション用スペクトルだけをclbに読み込む．スペクトル本体は読まない．
+        .ascのフォルダでは名前にcalibrationを含むファイル，スキャンファイルでは測定時にジョブで指定したファイルを使う．
+        Returns:
+            found (bool): キャリブレーション用スペクトルがあったか．
+        """
+        self.set_calibrator(center, pixels)
+        if os.path.isfile(path):
+            header, header_len = ScanFile.read_header(path)
+            return self.load_recorded_calibration(header['settings'])
+        filenames = [fn for fn in find_asc_files(path) if 'calibration' in fn.split(os.path.sep)[-1]]
+        for row in read_files(filenames):
+            self.clb.load_data_from_array(row)
+        return len(filenames) > 0
+
+    def load_recorded_calibration(self, settings: dict):
+        # スキャンファイルの設定に残したキャリブレーション用スペクトル
+        calibration_path = settings.get('calibration')
+        if calibration_path is None:
+            return False
+        if not os.path.isfile(calibration_path):
+            print(f'Calibration file not found: {calibration_path}')
+            return False
+        self.clb.load_data_from_path(calibration_path)
+        return True
+
+    def calibrated_wavelength(self):
+        """
+        Returns:
+            wavelength (np.ndarray): 校正した波長軸．キャリブレーション用スペクトルがないか校正できなければ校正前の波長軸．
+        """
+        if self.clb is None or self.clb.df is None:
+            print('No calibration spectrum. The nominal wavelength axis is used.')
+            return self.wl_data
+        if self.clb.degree is None:
+            return self.wl_data  # set_calibratorで知らせてある
+        self.calibrate()
+        if self.wl_data_calibrated is False:
+            print('Calibration failed. The nominal wavelength axis is used.')
+            return self.wl_data
+        return self.wl_data_calibrated
+
+    def open_window(self, path: str):
+        """
+        1つの窓のデータを読み込まずに開く．スペクトルは必要な範囲だけread(start, stop)で読む．
+        Args:
+            path (str): スキャンファイル(.rscan)か.ascの入ったフォルダ．
+
+        Returns:
+            num (int): 点数．
+            read (function): [start, stop)点目のスペクトルを(点数, 画素数)の配列で返す．
+            pixels (int): 画素数．
+        """
+        if os.path.isfile(path):
+            scan = ScanFile.open(path)
+            spectra = scan.spectra  # memmapなので読んだ範囲だけメモリに載る
+            order = position_order(scan)
+            if order is None:
+                def read(start, stop):
+                    return np.array(spectra[start:stop], dtype=float)
             else:
-                df.index = [filename_split]
-                df_list.append(df)
-                self.num_data += 1
-            # if 'calibration' not in df.index[0]:
-            #     self.num_data += 1
-        self.df = pd.concat(df_list, axis=0)
-
-    def calibrate(self, show=False):
+                def read(start, stop):
+                    return np.array(spectra[order[start:stop]], dtype=float)
+            return len(spectra), read, spectra.shape[1]
+
+        filenames = [fn for fn in find_asc_files(path) if 'calibration' not in fn.split(os.path.sep)[-1]]
+
+        def read(start, stop):
+            return np.array(read_files(filenames[start:stop]), dtype=float)
+        pixels = read(0, 1).shape[1] if filenames else 1024
+        return len(filenames), read, pixels
+
+    def calibrate(self, show=False, use_cache=True):
+        # 同じキャリブレーションのファイルなら前回の結果を使う
+        if use_cache:
+            self.wl_data_calibrated = CalibrationCache(self.cache_path).calibrate(self.clb, search_width=4, show=show)
+            return
         self.wl_data_calibrated = self.clb.calibrate(search_width=4)
         if show:
             self.clb.show_result()
 
     def remove_cosmic_ray(self, times: int = 0):
-        df_list = []
-        for name, data in self.df.iterrows():
-            if 'calibration' in name:
-                continue
-            z = data.values
-            for i in range(times):
-                z = fixed_z(z, 3)
-            df_new = pd.DataFrame(data=z).T
-            df_new.index = [name]
-            df_list.append(df_new)
-        self.df_without_cosmic_ray = pd.concat(df_list, axis=0)
+        self.stack.remove_cosmic_ray(times=times)
+        self.cosmic_ray_removed += times
 
     def draw(self, cosmic_ray_removal=False, surface=True):
-        df = self.df
-        if cosmic_ray_removal:
-            if self.df_without_cosmic_ray is None:
-                self.remove_cosmic_ray(times=1)
-            df = self.df_without_cosmic_ray
+        # 描画に使うものは描くときだけ読み込む
+        import matplotlib.pyplot as plt
+        import matplotlib.cm as cm
+        if cosmic_ray_removal and self.cosmic_ray_removed == 0:
+            self.remove_cosmic_ray(times=1)
+        z_surface = self.stack.data
 
         if self.wl_data_calibrated is None:
             x = self.wl_data
@@ -109,50 +212,165 @@ class DataProcessor:
         fig = plt.figure(figsize=(12, 8))
         ax = fig.add_subplot(projection='3d')
 
-        y_surface = np.arange(0, self.num_data)
-        z_surface = []
-        for i, (filename, data) in enumerate(df.iterrows()):
-            if 'calibration' in filename:
-                continue
-            y = [i] * df.shape[1]
-            z = data.values
-            if surface:
-                z_surface.append(z)
-            else:
-                ax.plot(x, y, z, color=cm.gist_earth(i / self.num_data))
-
+        num = len(z_surface)
         if surface:
-            x_mesh, y_mesh = np.meshgrid(x, y_surface)
-            z_surface = np.array(z_surface)
+            x_mesh, y_mesh = np.meshgrid(x, np.arange(0, num))
             ax.plot_surface(x_mesh, y_mesh, z_surface, cmap='gist_earth', rcount=1, ccount=1000)
             ax.set_zlim(0, ax.get_zlim()[1])
+        else:
+            for i, z in enumerate(z_surface):
+                ax.plot(x, [i] * len(z), z, color=cm.gist_earth(i / num))
 
         plt.show()
 
 
+def process_window(path: str, center: float, cosmic_ray_removal: int = 3, calibrate: bool = False,
+                   dtype=np.float64, out_path: str = None, cache_path: str = None):
+    """
+    1つの窓を読み込み，宇宙線除去と校正をする．別のプロセスで呼べるようにDataProcessorを毎回作る．
+    Args:
+        path (str): .ascのフォルダかスキャンファイル．
+        center (float): 中心波長 [nm]．
+        calibrate (bool): 波長軸を校正するか．フォルダではキャリブレーションのファイル，スキャンファイルでは測定時に指定したファイルを使う．
+        out_path (str): 指定するとスペクトルをこの.npyに書き，配列の代わりにファイル名を返す．
+        cache_path (str): 校正結果を残すファイル．Noneなら既定の場所．
+
+    Returns:
+        data (np.ndarray or str): (点数, 画素数)のスペクトルか，それを書いたファイル名．
+        wavelength (np.ndarray): 波長軸．
+    """
+    dp = DataProcessor(dtype=dtype, cache_path=cache_path)
+    if os.path.isfile(path):
+        dp.load_scan(path, center)
+    elif dp.load_data(path, center) is False:
+        raise ValueError(f'Failed in loading {path}')
+    dp.remove_cosmic_ray(times=cosmic_ray_removal)
+    wavelength = dp.calibrated_wavelength() if calibrate else dp.wl_data
+    if out_path is None:
+        return dp.stack.data, wavelength
+    out = np.lib.format.open_memmap(out_path, mode='w+', dtype=dp.stack.data.dtype, shape=dp.stack.data.shape)
+    out[:] = dp.stack.data
+    out.flush()
+    return out_path, wavelength
+
+
+def process_window_chunks(path: str, z_path: str, column: int, num: int, cosmic_ray_removal: int, chunk_size: int):
+    """
+    out-of-coreで1つの窓をchunk_size点ずつ宇宙線除去し，z_pathのmemmapの自分の列に書く．
+    Returns:
+        stats (tuple): 書いた値の(個数, 平均, 偏差平方和)．RunningStats.mergeで合わせる．
+    """
+    n, read, pixels = DataProcessor().open_window(path)
+    z_all = np.load(z_path, mmap_mode='r+')
+    stats = RunningStats()
+    for start in range(0, num, chunk_size):
+        stop = min(start + chunk_size, num)
+        z = read(start, stop)
+        for i in range(cosmic_ray_removal):
+            z = fixed_z_batch(z, 3)
+        z = z.astype(z_all.dtype, copy=False)  # 統計は書いた値から取る
+        z_all[start:stop, column:column + pixels] = z
+        stats.update(z)
+    z_all.flush()
+    return stats.n, stats.mean, stats.m2
+
+
 class WholeDataProcessor(DataProcessor):
-    def __init__(self, path_list: list, center_list: list, show: bool = True, cosmic_ray_removal: int = 3):
-        super().__init__()
+    """
+    複数の窓(中心波長)のデータを横に並べ，全体の平均と標準偏差で規格化する．
+    out_of_core=Trueにすると全体をメモリに載せず，chunk_size点ずつ処理してwork_dirのmemmap(z.npy, z_scaled.npy)に書く．
+    使うメモリはchunk_sizeで決まり，データの大きさによらない．memmapはdtypeで作るので，np.float32ならファイルも半分になる．
+    pathには.ascのフォルダのほかスキャンファイルも指定できる．
+    parallel=Trueにすると窓ごとに別のプロセスで読み込み・宇宙線除去・校正を行い，結果はmemmapで受け取る．
+    かかる時間は窓の合計ではなく一番遅い窓で決まる．
+    """
+    def __init__(self, path_list: list, center_list: list, show: bool = True, cosmic_ray_removal: int = 3,
+                 out_of_core: bool = False, work_dir: str = None, chunk_size: int = CHUNK_SIZE, dtype=np.float64,
+                 parallel: bool = False, calibrate: bool = False, cache_path: str = None):
+        super().__init__(dtype=dtype, cache_path=cache_path)
         if len(path_list) != len(center_list):
             print('Path list and center list must have same length.')
 
-        self.x = np.array([])
-        df_list = []
-        for path, center in zip(path_list, center_list):
-            self.load_data(path, center)
-            # self.calibrate(show=show)
-            self.remove_cosmic_ray(times=cosmic_ray_removal)
-            # self.x = np.hstack([self.x, self.wl_data_calibrated])
-            self.x = np.hstack([self.x, self.wl_data])
-            df_list.append(self.df_without_cosmic_ray)
-        df = pd.concat(df_list, axis=1)
-        self.y = np.arange(0, df.shape[0])
-        self.z = df.values
-        zmean = self.z.mean(keepdims=True)
-        zstd = np.std(self.z, keepdims=True)
-        self.z_scaled = (self.z - zmean) / zstd * 30
+        if out_of_core:
+            self.process_out_of_core(path_list, center_list, cosmic_ray_removal, work_dir, chunk_size, parallel, calibrate)
+            return
+
+        if parallel:
+            with tempfile.TemporaryDirectory(prefix='whole_data_') as tmp_dir:
+                with ProcessPoolExecutor(max_workers=len(path_list)) as executor:
+                    futures = [executor.submit(process_window, path, center, cosmic_ray_removal, calibrate, dtype,
+                                               os.path.join(tmp_dir, f'window{i}.npy'), cache_path)
+                               for i, (path, center) in enumerate(zip(path_list, center_list))]
+                    results = [future.result() for future in futures]
+                windows = [(np.load(out_path, mmap_mode='r'), wavelength) for out_path, wavelength in results]
+                self.stack_windows(windows)
+                del windows  # 一時フォルダを消す前にmemmapを閉じる
+        else:
+            self.stack_windows([process_window(path, center, cosmic_ray_removal, calibrate, dtype, cache_path=cache_path)
+                                for path, center in zip(path_list, center_list)])
+
+    def stack_windows(self, windows: list):
+        # 窓ごとの(スペクトル, 波長軸)を横に並べて規格化する
+        num = min(len(data) for data, wavelength in windows)
+        if any(len(data) != num for data, wavelength in windows):
+            print(f'Number of spectra differs between windows. Only the first {num} are used.')
+        self.x = np.hstack([wavelength for data, wavelength in windows])
+        self.y = np.arange(0, num)
+        self.z = np.hstack([data[:num] for data, wavelength in windows])
+        self.num_data = num * len(windows)
+        stats = RunningStats()  # np.stdのような全体の一時配列を作らない
+        for start in range(0, num, CHUNK_SIZE):
+            stats.update(self.z[start:start + CHUNK_SIZE])
+        self.z_scaled = self.z - stats.mean  # コピーは1つだけ作り，残りはその場で計算する
+        self.z_scaled /= stats.std
+        self.z_scaled *= 30
+
+    def process_out_of_core(self, path_list: list, center_list: list, cosmic_ray_removal: int, work_dir: str, chunk_size: int,
+                            parallel: bool = False, calibrate: bool = False):
+        if work_dir is None:
+            work_dir = tempfile.mkdtemp(prefix='whole_data_')
+        windows = [self.open_window(path) for path in path_list]
+        num = min(n for n, read, pixels in windows)
+        if any(n != num for n, read, pixels in windows):
+            print(f'Number of spectra differs between windows. Only the first {num} are used.')
+
+        # 校正はキャリブレーション用の1本だけで済むので，このプロセスで行う
+        wavelengths = []
+        for path, center, (n, read, pixels) in zip(path_list, center_list, windows):
+            if calibrate:
+                self.load_calibration(path, center, pixels)
+                wavelengths.append(self.calibrated_wavelength())
+            else:
+                wavelengths.append(np.linspace(center - 65, center + 65, pixels))
+        self.x = np.hstack(wavelengths)
+        self.y = np.arange(0, num)
+        self.num_data = num * len(windows)
+
+        # 1回目: 宇宙線を除いてzの各窓の列に書きながら統計を取る
+        z_path = os.path.join(work_dir, 'z.npy')
+        self.z = np.lib.format.open_memmap(z_path, mode='w+', dtype=self.dtype, shape=(num, self.x.size))
+        self.z.flush()
+        columns = np.cumsum([0] + [pixels for n, read, pixels in windows])[:-1]
+        args = [(path, z_path, int(column), num, cosmic_ray_removal, chunk_size) for path, column in zip(path_list, columns)]
+        if parallel:
+            with ProcessPoolExecutor(max_workers=len(path_list)) as executor:
+                results = [future.result() for future in [executor.submit(process_window_chunks, *arg) for arg in args]]
+        else:
+            results = [process_window_chunks(*arg) for arg in args]
+        stats = RunningStats()
+        for result in results:
+            stats.merge(*result)
+
+        # 2回目: 全体の平均と標準偏差で規格化する
+        self.z_scaled = np.lib.format.open_memmap(os.path.join(work_dir, 'z_scaled.npy'), mode='w+', dtype=self.dtype, shape=self.z.shape)
+        for start in range(0, num, chunk_size):
+            stop = min(start + chunk_size, num)
+            self.z_scaled[start:stop] = (self.z[start:stop] - stats.mean) / stats.std * 30
+        self.z_scaled.flush()
+        print(f'Results are written in {work_dir}')
 
     def draw_3d(self):
+        from mayavi import mlab  # VTKとQtを読み込むので重い
         s = mlab.surf(self.x * 100, self.y, self.z_scaled)
         mlab.show()
 
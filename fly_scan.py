@@ -0,0 +1,66 @@
+import numpy as np
+
+MAX_SPEED = 4000000  # HSC-103の最大速度 [pulse/s]
+MIN_POLL_INTERVAL = 0.02  # 位置のポーリング間隔の下限 [s]．Q:の往復より短くするとシリアル通信が埋まる
+
+
+class FlyScan:
+    """
+    ステージを一定速度で動かしながら連続撮影するスキャン．
+    startからgoalまでをnumber枚の撮影にかかる時間で移動するように各軸の速度を決め，
+    各フレームの位置は露光の中心時刻から求める．
+    """
+    def __init__(self, start, goal, number: int, cycle_time: float, exposure_time: float):
+        self.start = np.asarray(start, dtype=float)
+        self.goal = np.asarray(goal, dtype=float)
+        self.number = number
+        self.cycle_time = cycle_time  # 1フレームの周期 [s]．露光時間+読み出し時間
+        self.exposure_time = exposure_time
+        self.duration = number * cycle_time
+        self.velocity = (self.goal - self.start) / self.duration  # [pulse/s]
+
+    def get_speeds(self):
+        """
+        set_speedに渡す各軸の[axis, start, final, rate]．加減速させずに初速度から一定速度で動かす．
+        """
+        speeds = []
+        for axis, v in enumerate(np.abs(self.velocity)):
+            v = int(np.clip(np.round(v), 1, MAX_SPEED))
+            speeds.append([axis + 1, v, v, 1])
+        return speeds
+
+    def is_feasible(self):
+        return np.all(np.abs(self.velocity) <= MAX_SPEED)
+
+    def frame_times(self, t_acquisition: float):
+        # 各フレームの露光の中心時刻
+        return t_acquisition + np.arange(self.number) * self.cycle_time + self.exposure_time / 2
+
+    def model_positions(self, times, t_move: float):
+        # 移動開始時刻t_moveから一定速度で動いたとしたときの位置
+        elapsed = np.clip(np.asarray(times) - t_move, 0, self.duration)
+        return self.start + elapsed[:, None] * self.velocity
+
+    def correct_positions(self, times, positions, history):
+        """
+        get_positionで記録した(時刻, 位置)を補間して位置を補正する．
+        Args:
+            times (np.ndarray): 各フレームの時刻．
+            positions (np.ndarray): 補正前の位置 (N, 3)．
+            history (list): HSC103Controller.get_position_historyの戻り値．
+
+        Returns:
+            positions (np.ndarray): 補正後の位置．記録がフレームの時刻を覆っていない部分はそのまま．
+        """
+        if len(history) < 2:
+            return positions
+        t_history = np.array([t for t, _ in history])
+        pos_history = np.array([pos for _, pos in history], dtype=float)
+        order = np.argsort(t_history)
+        t_history = t_history[order]
+        pos_history = pos_history[order]
+        covered = (t_history[0] <= times) & (times <= t_history[-1])
+        corrected = np.array(positions, dtype=float)
+        for axis in range(3):
+            corrected[covered, axis] = np.interp(times[covered], t_history, pos_history[:, axis])
+        return corrected
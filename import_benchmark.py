@@ -0,0 +1,71 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+
+# 起動時に読み込むモジュール．画面，画面なしのスキャン，データ処理
+TARGETS = {
+    'gui': 'main',
+    'engine': 'scan_engine',
+    'processing': 'data_processor',
+    'calibration': 'calibration',
+}
+
+
+def run_import(module: str):
+    """
+    新しいPythonでmoduleをimportし，かかった時間を測る．
+    Returns:
+        elapsed (float): プロセスの起動から終了までの時間 [s]．
+        slowest (list(tuple)): -X importtimeで測ったimportの時間 [s]が長いモジュール．
+    """
+    code = 'pass' if module is None else f'import {module}'
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    t = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=cwd, capture_output=True, text=True)
+    elapsed = time.perf_counter() - t
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    # 子のモジュールは親より先に出力されるので，親の行が来るまで溜めておく
+    times = []
+    children = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            children.append((name.strip(), int(cumulative_us) * 1e-6))
+        elif depth == 0:
+            if name.strip() == module:
+                times = children
+            children = []
+    return elapsed, sorted(times, key=lambda item: item[1], reverse=True)[:5]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure cold-start import time.')
+    parser.add_argument('targets', nargs='*', default=list(TARGETS), help=f'some of {list(TARGETS)}')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # Python自体の起動時間を差し引く
+    baseline = np.median([run_import(None)[0] for _ in range(args.repeat)])
+    print(f'interpreter: {baseline * 1000:.0f} ms')
+    for target in args.targets:
+        module = TARGETS.get(target, target)
+        try:
+            results = [run_import(module) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f'{target} ({module}): failed: {e}')
+            continue
+        elapsed = np.median([elapsed for elapsed, slowest in results]) - baseline
+        slowest = ', '.join(f'{name} {seconds * 1000:.0f} ms' for name, seconds in results[-1][1])
+        print(f'{target} ({module}): {elapsed * 1000:.0f} ms  [{slowest}]')
+
+
+if __name__ == '__main__':
+    main()
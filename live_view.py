@@ -0,0 +1,142 @@
+import numpy as np
+
+
+class LiveSpectrumView:
+    """
+    測定中のスペクトルを表示する．
+    線は1本だけ作っておきset_dataで更新し，普段は線の部分だけをblitで描き直す．
+    軸の範囲が変わるときだけ全体を描き直す．新しいスペクトルが来ていなければ何もしない．
+    """
+    def __init__(self, fig, ax, canvas, max_points: int = 0):
+        self.fig = fig
+        self.ax = ax
+        self.canvas = canvas
+        self.max_points = max_points  # 0なら間引かない
+        self.version = None
+        self.background = None
+        self.line, = self.ax.plot([], [], animated=True)
+        self.ax.set_xticks([])
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event):
+        # 全体を描き直したら背景を取り直す
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.ax.draw_artist(self.line)
+
+    def decimate(self, y):
+        # 表示用に各区間の最小値・最大値だけを残す
+        y = np.asarray(y, dtype=float)
+        n = y.size
+        if self.max_points <= 0 or n <= self.max_points:
+            return np.arange(n), y.copy()
+        width = int(np.ceil(n / max(self.max_points // 2, 1)))  # 1区間で最小値と最大値の2点になる
+        pad = -n % width
+        y_block = np.pad(y, (0, pad), mode='edge').reshape(-1, width)
+        x = np.repeat(np.arange(0, n, width) + (width - 1) / 2, 2)
+        y = np.column_stack([y_block.min(axis=1), y_block.max(axis=1)]).ravel()
+        return x, y
+
+    def need_rescale(self, x, y):
+        x_lim = self.ax.get_xlim()
+        y_lim = self.ax.get_ylim()
+        y_min, y_max = y.min(), y.max()
+        if x[0] < x_lim[0] or x_lim[1] < x[-1]:
+            return True
+        if y_min < y_lim[0] or y_lim[1] < y_max:
+            return True
+        # 信号が小さくなって見づらくなった場合も合わせ直す
+        return (y_max - y_min) < 0.5 * (y_lim[1] - y_lim[0])
+
+    def update(self, spectrum, version):
+        if spectrum is None or np.size(spectrum) == 0 or version == self.version:
+            return False
+        self.version = version
+        x, y = self.decimate(spectrum)
+        self.line.set_data(x, y)
+        if self.background is None or self.need_rescale(x, y):
+            self.ax.set_xlim(x[0], x[-1])
+            margin = (y.max() - y.min()) * 0.05 or 1
+            self.ax.set_ylim(y.min() - margin, y.max() + margin)
+            self.canvas.draw()  # on_drawで背景を取り直す
+        else:
+            self.canvas.restore_region(self.background)
+            self.ax.draw_artist(self.line)
+            self.canvas.blit(self.ax.bbox)
+        return True
+
+
+class LiveWaterfall:
+    """
+    自動スキャンの全体像を(点数×画素数)の画像として表示する．
+    画像のバッファは最初に確保し，1点終わるごとに1行ずつ埋めてset_dataで更新する．
+    """
+    def __init__(self, fig, ax, canvas):
+        self.fig = fig
+        self.ax = ax
+        self.canvas = canvas
+        self.buffer = None
+        self.image = None
+        self.background = None
+        self.version = 0  # 行を埋めるたびに増やす
+        self.version_drawn = 0
+        self.need_layout = False
+        self.v_min = np.inf
+        self.v_max = -np.inf
+        self.ax.set_xticks([])
+        self.ax.set_ylabel('step')
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event):
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        if self.image is not None:
+            self.ax.draw_artist(self.image)
+
+    def reset(self, steps: int, pixels: int):
+        # スキャンのスレッドから呼んでよい．軸と画像の作り直しはupdateでメインスレッドから行う
+        self.buffer = np.full((steps, pixels), np.nan)
+        self.v_min = np.inf
+        self.v_max = -np.inf
+        self.need_layout = True
+        self.version += 1
+
+    def layout(self):
+        steps, pixels = self.buffer.shape
+        extent = (-0.5, pixels - 0.5, steps + 0.5, 0.5)
+        if self.image is None:
+            self.image = self.ax.imshow(self.buffer, aspect='auto', interpolation='nearest', cmap='gist_earth', extent=extent, animated=True)
+        else:
+            self.image.set_data(self.buffer)
+            self.image.set_extent(extent)
+        self.ax.set_xlim(extent[0], extent[1])
+        self.ax.set_ylim(extent[2], extent[3])
+        self.need_layout = False
+        self.canvas.draw()
+
+    def set_row(self, index: int, spectrum):
+        # スキャンのスレッドから呼んでよい．描画はupdateで行う
+        if self.buffer is None or not 0 <= index < self.buffer.shape[0]:
+            return
+        row = self.buffer[index]
+        np.copyto(row, spectrum)
+        self.v_min = min(self.v_min, np.nanmin(row))
+        self.v_max = max(self.v_max, np.nanmax(row))
+        self.version += 1
+
+    def update(self):
+        if self.version == self.version_drawn:
+            return False
+        if self.need_layout:
+            self.layout()
+        if self.image is None:
+            return False
+        self.version_drawn = self.version
+        self.image.set_data(self.buffer)
+        if self.v_min < self.v_max:
+            self.image.set_clim(self.v_min, self.v_max)
+        if self.background is None:
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            self.ax.draw_artist(self.image)
+            self.canvas.blit(self.ax.bbox)
+        return True
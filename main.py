@@ -1,59 +1,47 @@
-import os, time, serial, threading, sys, csv, math
+import os, time, threading, sys
 import tkinter as tk
-from tkinter import ttk
-import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-if os.name == 'nt':
-    from pyAndorSDK2 import atmcd, atmcd_codes, atmcd_errors
-else:
-    atmcd =  atmcd_codes = atmcd_errors = None
+from tkinter import ttk, filedialog
 from ConfigLoader import ConfigLoader
-from HSC103Controller import HSC103Controller
-from EmptySdk import EmptySdk
+from live_view import LiveSpectrumView, LiveWaterfall
+from scan_engine import ScanEngine, ScanJob, UM_PER_PULSE
+from scan_journal import JOURNAL_EXTENSION
 
 
-UM_PER_PULSE = 0.01
 WIDTH = 10
 FONT = ('游ゴシック', 20)
 
 
 class MinimalWindow(tk.Frame):
+    """
+    ScanEngineを操作する画面．撮影とスキャンはすべてScanEngineが行い，画面は設定を渡して進み具合を表示する．
+    """
     def __init__(self, master, config='./config.json'):
         super().__init__(master)
         self.master = master
         self.master.title('RAS')
 
         self.cl = ConfigLoader(config)
-
-        if self.cl.mode == 'RELEASE':
-            folder = self.cl.folder
-            if not os.path.exists(folder):
-                os.mkdir(folder)
-
-        self.open_ports()
-
-        self.spec_accumulated = None
-        self.locations = [['x', 'y', 'z']]
+        self.engine = ScanEngine(self.cl)
+        self.hsc = self.engine.hsc
 
         self.set_style()
         self.create_widgets()
 
+        # エンジンはスキャンのスレッドから知らせるので，画面の更新はafterでメインスレッドに回す
+        self.engine.on_state = self.in_main_thread(self.state.set)
+        self.engine.on_message = self.in_main_thread(self.msg.set)
+        self.engine.on_temperature = self.in_main_thread(lambda temperature: self.temperature.set('現在：' + str(temperature) + '℃'))
+        self.engine.on_progress = self.in_main_thread(self.number.set)
+        self.engine.on_scan_start = self.in_main_thread(self.on_scan_start)
+
         self.create_and_start_thread_pos()
 
-        self.update_graph()
+        # matplotlibの読み込みは重いので，画面を出してからグラフを作る
+        self.master.after(1, self.create_graphs)
 
-    def open_ports(self):
-        if self.cl.mode == 'RELEASE':
-            self.sdk = atmcd()
-            self.ser = serial.Serial(self.cl.port, self.cl.baudrate, write_timeout=0)
-            self.hsc = HSC103Controller(self.ser)
-        elif self.cl.mode == 'DEBUG':
-            self.sdk = EmptySdk()
-            self.ser = None
-            self.hsc = HSC103Controller(self.ser)
-        else:
-            raise ValueError('Error with config.json. mode must be DEBUG or RELEASE.')
+    def in_main_thread(self, func):
+        # 別スレッドから呼ばれてもfuncはTkのメインループで順に実行される
+        return lambda *args: self.master.after(0, func, *args)
 
     def set_style(self):
         style = ttk.Style()
@@ -75,14 +63,20 @@ class MinimalWindow(tk.Frame):
         self.thread_cool.start()
 
     def create_and_start_thread_acq(self):
-        # autoで画面がフリーズしないようthreadを立てる
-        self.thread_acq = threading.Thread(target=self.prepare_and_acquire)
+        # 入力はメインスレッドで読んでから，autoで画面がフリーズしないようthreadを立てる
+        job = self.get_job()
+        if job.snr_mode and self.cl.acquisition_mode != 'SINGLE':
+            self.msg.set('SN比モードはSINGLEのみ')
+            return
+        self.set_inputs_state(tk.DISABLED)
+        self.thread_acq = threading.Thread(target=self.prepare_and_acquire, args=(job,))
         self.thread_acq.daemon = True
         self.thread_acq.start()
 
-    def create_and_start_thread_auto(self):
-        # autoで画面がフリーズしないようthreadを立てる
-        self.thread_auto = threading.Thread(target=self.auto_acquire_and_save)
+    def create_and_start_thread_auto(self, job=None, journal_path=None):
+        # 入力はメインスレッドで読んでから，autoで画面がフリーズしないようthreadを立てる
+        self.set_auto_state(tk.DISABLED)
+        self.thread_auto = threading.Thread(target=self.run_auto, args=(job, journal_path))
         self.thread_auto.daemon = True
         self.thread_auto.start()
 
@@ -196,6 +190,28 @@ class MinimalWindow(tk.Frame):
         self.entry_filename.grid(row=5, column=0)
         self.combobox_extension.grid(row=5, column=1)
         self.button_save.grid(row=5, column=2)
+        # SN比が目標に届くまで積算するモード
+        self.snr_mode = tk.BooleanVar(value=False)
+        self.checkbutton_snr = ttk.Checkbutton(master=self.frame_andor, text='目標SN比：', variable=self.snr_mode)
+        self.snr_target = tk.DoubleVar(value=100)
+        self.entry_snr_target = ttk.Entry(master=self.frame_andor, textvariable=self.snr_target, width=WIDTH, justify=tk.CENTER)
+        self.label_snr_region = ttk.Label(master=self.frame_andor, text='範囲[pixel]：')
+        self.snr_region_start = tk.IntVar(value=0)
+        self.snr_region_end = tk.IntVar(value=1024)
+        self.entry_snr_region_start = ttk.Entry(master=self.frame_andor, textvariable=self.snr_region_start, width=WIDTH, justify=tk.CENTER)
+        self.entry_snr_region_end = ttk.Entry(master=self.frame_andor, textvariable=self.snr_region_end, width=WIDTH, justify=tk.CENTER)
+        self.label_snr_time = ttk.Label(master=self.frame_andor, text='上限時間：')
+        self.snr_time = tk.DoubleVar(value=60)
+        self.entry_snr_time = ttk.Entry(master=self.frame_andor, textvariable=self.snr_time, width=WIDTH, justify=tk.CENTER)
+        self.label_snr_second = ttk.Label(master=self.frame_andor, text='sec')
+        self.checkbutton_snr.grid(row=6, column=0)
+        self.entry_snr_target.grid(row=6, column=1)
+        self.label_snr_region.grid(row=7, column=0)
+        self.entry_snr_region_start.grid(row=7, column=1)
+        self.entry_snr_region_end.grid(row=7, column=2)
+        self.label_snr_time.grid(row=8, column=0)
+        self.entry_snr_time.grid(row=8, column=1)
+        self.label_snr_second.grid(row=8, column=2)
 
         # frame_auto
         self.label_step = ttk.Label(master=self.frame_auto, text='回数：')
@@ -206,29 +222,68 @@ class MinimalWindow(tk.Frame):
         self.progressbar = ttk.Progressbar(master=self.frame_auto, orient=tk.HORIZONTAL, variable=self.number, maximum=10, length=200, mode='determinate')
         self.state = tk.StringVar(value='Not Ready')
         self.label_state = ttk.Label(master=self.frame_auto, textvariable=self.state)
+        self.label_scan_mode = ttk.Label(master=self.frame_auto, text='形状：')
+        self.scan_mode = tk.StringVar(value='Line')
+        self.combobox_scan_mode = ttk.Combobox(master=self.frame_auto, values=('Line', 'Grid', 'Fly', 'Adaptive'), textvariable=self.scan_mode, width=WIDTH, justify=tk.CENTER, state='readonly')
+        self.label_budget = ttk.Label(master=self.frame_auto, text='上限：')
+        self.budget = tk.IntVar(value=50)
+        self.entry_budget = ttk.Entry(master=self.frame_auto, textvariable=self.budget, width=WIDTH, justify=tk.CENTER)
+        self.label_grid = ttk.Label(master=self.frame_auto, text='x, y, z：')
+        self.step_x = tk.IntVar(value=10)
+        self.step_y = tk.IntVar(value=10)
+        self.step_z = tk.IntVar(value=1)
+        self.entry_step_x = ttk.Entry(master=self.frame_auto, textvariable=self.step_x, width=WIDTH, justify=tk.CENTER)
+        self.entry_step_y = ttk.Entry(master=self.frame_auto, textvariable=self.step_y, width=WIDTH, justify=tk.CENTER)
+        self.entry_step_z = ttk.Entry(master=self.frame_auto, textvariable=self.step_z, width=WIDTH, justify=tk.CENTER)
         self.label_step.grid(row=0, column=0)
         self.entry_step.grid(row=0, column=1)
         self.button_start_auto.grid(row=0, column=2)
         self.progressbar.grid(row=0, column=3)
-        self.label_state.grid(row=1, column=0, columnspan=4)
+        self.label_scan_mode.grid(row=1, column=0)
+        self.combobox_scan_mode.grid(row=1, column=1)
+        self.label_budget.grid(row=1, column=2)
+        self.entry_budget.grid(row=1, column=3)
+        self.label_grid.grid(row=2, column=0)
+        self.entry_step_x.grid(row=2, column=1)
+        self.entry_step_y.grid(row=2, column=2)
+        self.entry_step_z.grid(row=2, column=3)
+        self.label_state.grid(row=3, column=0, columnspan=4)
+        self.button_resume = ttk.Button(master=self.frame_auto, text='RESUME', command=self.resume, width=WIDTH, state=tk.DISABLED)
+        self.button_resume.grid(row=4, column=2)
+
+        # quit
+        self.button_quit = ttk.Button(master=self.master, text='QUIT', command=self.quit, style='red.TButton')
+        self.button_quit.grid(row=3, column=0, sticky=tk.NSEW)
 
-        # frame_graph
+    def create_graphs(self):
+        import matplotlib.pyplot as plt
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
         self.fig = plt.figure(figsize=(5, 5))
         self.ax = self.fig.add_subplot(1, 1, 1)
         self.canvas = FigureCanvasTkAgg(self.fig, master=self.frame_graph)
         self.canvas.get_tk_widget().grid(row=0, column=0)
-        # quit
-        self.button_quit = ttk.Button(master=self.master, text='QUIT', command=self.quit, style='red.TButton')
-        self.button_quit.grid(row=3, column=0, sticky=tk.NSEW)
+        self.canvas.draw()
+        self.live_view = LiveSpectrumView(self.fig, self.ax, self.canvas, max_points=self.cl.display_points)
+        self.fig_waterfall = plt.figure(figsize=(5, 3))
+        self.ax_waterfall = self.fig_waterfall.add_subplot(1, 1, 1)
+        self.canvas_waterfall = FigureCanvasTkAgg(self.fig_waterfall, master=self.frame_graph)
+        self.canvas_waterfall.get_tk_widget().grid(row=1, column=0)
+        self.canvas_waterfall.draw()
+        self.waterfall = LiveWaterfall(self.fig_waterfall, self.ax_waterfall, self.canvas_waterfall)
+        self.engine.on_row = self.in_main_thread(self.waterfall.set_row)
+        self.update_graph()
 
     def update_position(self):
+        # 位置はHSC103Controllerがポーリングしてキャッシュしたものを表示する
         while True:
-            x, y, z = self.hsc.get_position()
-            self.x_cr.set(round(x * UM_PER_PULSE, 2))
-            self.y_cr.set(round(y * UM_PER_PULSE, 2))
-            self.z_cr.set(round(z * UM_PER_PULSE, 2))
+            self.in_main_thread(self.show_position)(*self.hsc.get_position())
             time.sleep(self.cl.dt * 0.001)
 
+    def show_position(self, x, y, z):
+        self.x_cr.set(round(x * UM_PER_PULSE, 2))
+        self.y_cr.set(round(y * UM_PER_PULSE, 2))
+        self.z_cr.set(round(z * UM_PER_PULSE, 2))
+
     def set_start(self):
         self.x_st.set(self.x_cr.get())
         self.y_st.set(self.y_cr.get())
@@ -246,98 +301,70 @@ class MinimalWindow(tk.Frame):
         self.hsc.move_linear([x, y, z])
 
     def stop(self):
-        self.hsc.stop_emergency()
+        self.engine.stop()
 
     def initialize(self):
-        # 初期化
-        if self.cl.mode == 'RELEASE':
-            if self.sdk.Initialize('') == atmcd_errors.Error_Codes.DRV_SUCCESS:
-                self.msg.set('初期化成功')
-                self.label_msg.config(background='#00ff00')
-                self.button_initialize.config(state=tk.DISABLED)
-            else:
-                self.msg.set('初期化失敗')
-                self.label_msg.config(background='#ff0000')
-        elif self.cl.mode == 'DEBUG':
-            print('skipped initialization')
+        # 初期化してcoolerをonに
+        if self.engine.initialize():
             self.msg.set('初期化成功')
             self.label_msg.config(background='#00ff00')
             self.button_initialize.config(state=tk.DISABLED)
-        # coolerをonに
-        self.sdk.SetTemperature(self.cl.temperature)
-        self.sdk.CoolerON()
+        else:
+            self.msg.set('初期化失敗')
+            self.label_msg.config(background='#ff0000')
         self.create_and_start_thread_cool()
 
     def update_temperature(self):
-        if self.cl.mode == 'RELEASE':
-            while True:
-                ret, temperature = self.sdk.GetTemperature()
-                self.temperature.set('現在：' + str(temperature) + '℃')
-                if ret == atmcd_errors.Error_Codes.DRV_TEMP_STABILIZED:
-                    break
-                time.sleep(self.cl.dt * 0.001)
-        elif self.cl.mode == 'DEBUG':
-            print('skip updating temperature')
+        self.engine.wait_for_cooling()
+        self.in_main_thread(self.on_cooled)()
 
+    def on_cooled(self):
         self.msg.set('冷却完了')
         self.label_temperature.config(background='blue')
         self.button_acquire.config(state=tk.ACTIVE)
         self.button_start_auto.config(state=tk.ACTIVE)
+        self.button_resume.config(state=tk.ACTIVE)
         self.state.set('Ready to Start')
 
-    def prepare_acquisition(self):
-        if self.cl.mode == 'RELEASE':
-            self.sdk.handle_return(self.sdk.SetAcquisitionMode(atmcd_codes.Acquisition_Mode.SINGLE_SCAN))
-            self.sdk.handle_return(self.sdk.SetReadMode(atmcd_codes.Read_Mode.FULL_VERTICAL_BINNING))
-            self.sdk.handle_return(self.sdk.SetTriggerMode(atmcd_codes.Trigger_Mode.INTERNAL))
-            ret, self.xpixels, ypixels = self.sdk.GetDetector()
-            self.sdk.handle_return(ret)
-            self.sdk.handle_return(self.sdk.SetExposureTime(self.exposure_time.get()))  # TODO: 露光時間入力の例外処理
-            self.sdk.handle_return(self.sdk.PrepareAcquisition())
-        elif self.cl.mode == 'DEBUG':
-            print('prepare acquisition')
-
-    def acquire(self):
-        self.spec_accumulated = 0
-        for i in range(self.accumulation_times.get()):
-            self.msg.set(f'Acquisition {i + 1}/{self.accumulation_times.get()}')
-            if self.cl.mode == 'RELEASE':
-                self.sdk.handle_return(self.sdk.StartAcquisition())
-                self.sdk.handle_return(self.sdk.WaitForAcquisition())
-                ret, spec, first, last = self.sdk.GetImages16(1, 1, self.xpixels)
-                self.spec_accumulated += np.array(spec)
-                self.sdk.handle_return(ret)
-            elif self.cl.mode == 'DEBUG':
-                print('acquired')
-                spec = np.sin(np.linspace(0, np.random.rand() * 10, 100))
-                self.spec_accumulated += spec
-                time.sleep(0.5)
-        self.msg.set('Finished Acquisition')
-
     def update_graph(self):
-        if self.spec_accumulated is None or isinstance(self.spec_accumulated, int):
-            pass
-        else:
-            self.draw()
-        self.master.after(1000, self.update_graph)
+        # 新しいスペクトルがあるときだけ描き直すので，短い間隔で確認してよい
+        self.draw()
+        self.master.after(self.cl.dt, self.update_graph)
 
     def draw(self):
-        self.ax.cla()
-        self.ax.plot(self.spec_accumulated)
-        self.ax.set_xticks([])
-        self.canvas.draw()
+        self.live_view.update(self.engine.spec_accumulated, self.engine.spec_version)
+        self.waterfall.update()
 
-    def prepare_and_acquire(self):
-        self.entry_exposure_time.config(state=tk.DISABLED)
-        self.entry_accumulation_times.config(state=tk.DISABLED)
-        self.button_acquire.config(state=tk.DISABLED)
-        self.button_save.config(state=tk.DISABLED)
-        self.prepare_acquisition()
-        self.acquire()
-        self.entry_exposure_time.config(state=tk.ACTIVE)
-        self.entry_accumulation_times.config(state=tk.ACTIVE)
-        self.button_acquire.config(state=tk.ACTIVE)
-        self.button_save.config(state=tk.ACTIVE)
+    def get_job(self):
+        # 画面の入力からジョブを作る
+        if self.scan_mode.get() == 'Grid':
+            steps = self.get_grid_steps()
+        else:
+            steps = self.max_step.get()
+        return ScanJob(start=self.get_start(), goal=self.get_goal(), steps=steps, mode=self.scan_mode.get(),
+                       exposure_time=self.exposure_time.get(), accumulation_times=self.accumulation_times.get(),
+                       budget=self.budget.get(), snr_mode=self.snr_mode.get(), snr_target=self.snr_target.get(),
+                       snr_region=[self.snr_region_start.get(), self.snr_region_end.get()], snr_time=self.snr_time.get())
+
+    def set_inputs_state(self, state):
+        self.entry_exposure_time.config(state=state)
+        self.entry_accumulation_times.config(state=state)
+        self.button_acquire.config(state=state)
+        self.button_save.config(state=state)
+
+    def set_auto_state(self, state):
+        self.set_inputs_state(state)
+        self.button_start_auto.config(state=state)
+        self.button_resume.config(state=state)
+
+    def prepare_and_acquire(self, job):
+        try:
+            self.engine.prepare_acquisition(job)
+            self.engine.acquire(job)
+        except Exception as e:
+            self.in_main_thread(self.msg.set)(f'測定失敗: {e}')
+        finally:
+            self.in_main_thread(self.set_inputs_state)(tk.ACTIVE)
 
     def save_as(self, filename=None):
         if filename is None:
@@ -348,26 +375,12 @@ class MinimalWindow(tk.Frame):
             path = filename
 
         if self.extension.get() == '.sif':
-            self.save_as_sif(path + '.sif')
+            self.engine.save_as_sif(path + '.sif')
         elif self.extension.get() == '.asc':
-            self.save_as_asc(path + '.asc')
+            self.engine.save_as_asc(path + '.asc')
         else:
             self.state.set('Invalid extension')
 
-    def save_as_sif(self, path):
-        if self.cl.mode == 'RELEASE':
-            self.sdk.handle_return(self.sdk.SaveAsSif(path))
-        elif self.cl.mode == 'DEBUG':
-            print('saved')
-
-    def save_as_asc(self, path):
-        if self.cl.mode == 'RELEASE':
-            spec_str = list(map(lambda x: str(x) + '\n', self.spec_accumulated))
-            with open(path, 'w') as f:
-                f.writelines(spec_str)
-        elif self.cl.mode == 'DEBUG':
-            print('saved')
-
     def get_start(self):
         x = self.x_st.get()
         y = self.y_st.get()
@@ -386,78 +399,41 @@ class MinimalWindow(tk.Frame):
         z = self.z_gl.get()
         return [x, y, z]
 
+    def get_grid_steps(self):
+        return [self.step_x.get(), self.step_y.get(), self.step_z.get()]
+
     def start_auto(self):
-        if self.max_step.get() <= 0:
-            self.state.set('Step must be greater than 0')
+        job = self.get_job()
+        error = job.validate(self.cl.acquisition_mode)
+        if error is not None:
+            self.state.set(error)
             return
-        self.state.set('Setting up...')
-
-        self.prepare_acquisition()
-
-        self.hsc.set_speed_max()
-        # 座標計算
-        self.start = np.array(self.get_start()).astype('float') / UM_PER_PULSE
-        current = np.array(self.get_current()).astype('float') / UM_PER_PULSE
-        self.goal = np.array(self.get_goal()).astype('float') / UM_PER_PULSE
-
-        # start位置に移動
-        self.hsc.move_abs(self.start)
-        distance = np.linalg.norm(np.array(current - self.start))
-        time.sleep(distance / 40000 + 1)  # TODO: 到着を確認してから次に進む
-
-        # ProgressBarの設定
-        self.progressbar.config(maximum=self.max_step.get())
-        self.number.set(1)
-
-        self.create_and_start_thread_auto()
-
-    def auto_acquire_and_save(self):
-        self.entry_exposure_time.config(state=tk.DISABLED)
-        self.entry_accumulation_times.config(state=tk.DISABLED)
-        self.button_acquire.config(state=tk.DISABLED)
-        self.button_save.config(state=tk.DISABLED)
-        self.button_start_auto.config(state=tk.DISABLED)
-
-        number = 1
-        step = self.max_step.get()
-        while number <= step:
-            time_left = math.ceil((step - number + 1) * self.exposure_time.get() * 2  * self.accumulation_times.get() / 60)
-            self.state.set(f'Acquisition {number} of {step}... {time_left} minutes left')
-
-            point = self.start + (self.goal - self.start) * (number - 1) / (step - 1)
-            self.hsc.move_abs(point)
-            self.locations.append(point * UM_PER_PULSE)
-            distance = np.linalg.norm(np.array(point - self.start))
-            time.sleep(distance / 40000 + 1)  # TODO: 到着を確認してから次に進む
-
-            self.acquire()
-
-            self.save_as_asc(os.path.join(os.getcwd(), 'data', f'{number}of{step}.asc'))
-
-            number += 1
-            self.number.set(number)
-            self.locations_to_csv()
-
-        self.state.set('Auto Acquisition Finished')
-        self.entry_exposure_time.config(state=tk.ACTIVE)
-        self.entry_accumulation_times.config(state=tk.ACTIVE)
-        self.button_acquire.config(state=tk.ACTIVE)
-        self.button_save.config(state=tk.ACTIVE)
-        self.button_start_auto.config(state=tk.ACTIVE)
-
-    def locations_to_csv(self):
-        if self.cl.mode == 'RELEASE':
-            filename = os.path.join(self.cl.folder, 'location.csv')
-            with open(filename, 'w', newline='') as f:
-                writer = csv.writer(f)
-                writer.writerows(self.locations)
-        else:
-            print('locations saved')
+        self.create_and_start_thread_auto(job)
+
+    def on_scan_start(self, steps, pixels):
+        # ProgressBarとwaterfallの設定
+        self.progressbar.config(maximum=steps)
+        self.waterfall.reset(steps, pixels)
+
+    def run_auto(self, job=None, journal_path=None):
+        # スキャンのスレッドで動く．何が起きてもボタンは戻す
+        try:
+            if journal_path is None:
+                self.engine.run_job(job)
+            else:
+                self.engine.resume(journal_path)
+        finally:
+            self.in_main_thread(self.set_auto_state)(tk.ACTIVE)
+
+    def resume(self):
+        # 途中で止まったスキャンの記録を選んで続きから測る
+        path = filedialog.askopenfilename(initialdir=self.cl.folder, filetypes=[('Scan journal', '*' + JOURNAL_EXTENSION)])
+        if not path:
+            return
+        self.create_and_start_thread_auto(journal_path=path)
 
     def quit(self):
-        if self.cl.mode == 'RELEASE':
-            self.sdk.ShutDown()
-            self.ser.close()
+        self.engine.close()
         self.master.destroy()
         sys.exit()  # デーモン化してあるスレッドはここで死ぬ
 
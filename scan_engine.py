@@ -0,0 +1,818 @@
+import os, time, serial, math, json, queue, argparse
+import numpy as np
+if os.name == 'nt':
+    from pyAndorSDK2 import atmcd
+else:
+    atmcd = None
+from ConfigLoader import ConfigLoader
+from HSC103Controller import HSC103Controller
+from EmptySdk import EmptySdk, atmcd_codes, atmcd_errors
+from accumulator import SpectrumAccumulator
+from scan_plan import ScanPlan, AdaptiveLinePlan
+from fly_scan import FlyScan, MIN_POLL_INTERVAL
+from scan_file import ScanFile, BackgroundWriter, EXTENSION
+from stream_processor import StreamProcessor, PROCESSED_SUFFIX
+from scan_trace import ScanTrace, TRACE_EXTENSION
+from scan_journal import ScanJournal, JOURNAL_EXTENSION
+
+
+UM_PER_PULSE = 0.01
+HARDWARE_MODES = ['RELEASE', 'SIMULATION']  # カメラとステージを実際に動かすモード
+SCAN_MODES = ['Line', 'Grid', 'Fly', 'Adaptive', 'Points']
+
+
+def ignore(*args):
+    pass
+
+
+class ScanJob:
+    """
+    1回の撮影・スキャンの設定．レシピの1項目に当たる．位置は[μm]で指定する．
+    stepsはLine, Fly, Adaptiveでは点数，Gridでは[x, y, z]の点数．
+    Pointsではpointsに並べた[x, y, z]の点を，startから移動量が小さくなる順に並べ替えて測る．stepsとgoalは使わない．
+    """
+    def __init__(self, start=(0, 0, 0), goal=(0, 0, 0), steps=10, mode: str = 'Line', exposure_time: float = 10,
+                 accumulation_times: int = 1, budget: int = 50, snr_mode: bool = False, snr_target: float = 100,
+                 snr_region=(0, 1024), snr_time: float = 60, folder: str = None, name: str = None,
+                 center: float = None, calibration: str = None, points=None):
+        self.start = [float(v) for v in start]
+        self.goal = [float(v) for v in goal]
+        self.steps = steps
+        self.mode = mode
+        self.exposure_time = float(exposure_time)
+        self.accumulation_times = int(accumulation_times)
+        self.budget = int(budget)  # Adaptiveで測る点数の上限
+        self.snr_mode = bool(snr_mode)
+        self.snr_target = float(snr_target)
+        self.snr_region = [int(v) for v in snr_region]
+        self.snr_time = float(snr_time)
+        self.folder = folder  # Noneならconfig.jsonのFOLDER
+        self.name = name
+        self.center = None if center is None else float(center)  # 中心波長 [nm]．処理済みデータの波長軸に使う
+        self.calibration = calibration  # キャリブレーション用のスペクトル(.asc)．Noneなら校正しない
+        self.points = None if points is None else np.asarray(points, dtype=float).tolist()  # Pointsで測る点 [μm]
+
+    @classmethod
+    def from_dict(cls, d: dict):
+        try:
+            return cls(**d)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f'Invalid job {d}: {e}')
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    def validate(self, acquisition_mode: str = 'SINGLE'):
+        """
+        Args:
+            acquisition_mode (str): config.jsonのACQUISITION_MODE．
+
+        Returns:
+            error (str): 設定がおかしければその内容．問題なければNone．
+        """
+        if self.mode not in SCAN_MODES:
+            return f'mode must be one of {SCAN_MODES}'
+        if len(self.start) != 3 or len(self.goal) != 3:
+            return 'start and goal must have three values'
+        if self.mode == 'Grid':
+            if np.size(self.steps) != 3 or min(self.steps) <= 0:
+                return 'Steps must be greater than 0'
+        elif self.mode == 'Points':
+            points = np.asarray(self.points if self.points is not None else [], dtype=float)
+            if points.ndim != 2 or points.shape[0] == 0 or points.shape[1] != 3:
+                return 'points must be a non-empty list of [x, y, z]'
+            if not np.all(np.isfinite(points)):
+                return 'points must be finite numbers'
+        elif np.size(self.steps) != 1 or int(self.steps) <= 0:
+            return 'Step must be greater than 0'
+        if self.exposure_time <= 0 or self.accumulation_times <= 0:
+            return 'exposure_time and accumulation_times must be greater than 0'
+        if self.snr_mode and (acquisition_mode != 'SINGLE' or self.mode == 'Fly'):
+            # SN比は1枚ずつ撮って確かめるので，まとめて撮る積算・連続撮影やFlyでは使えない
+            return 'SNR mode requires ACQUISITION_MODE SINGLE and a step scan'
+        if self.calibration is not None and self.center is None:
+            return 'center is required for calibration'
+        if self.calibration is not None and not os.path.isfile(self.calibration):
+            return f'calibration file not found: {self.calibration}'
+        return None
+
+
+class ScanEngine:
+    """
+    カメラとステージを持ち，撮影とスキャンを行う．画面を持たず，進み具合はon_で始まる関数で知らせる．
+    Tkの画面もコマンドラインもこのクラスを使う．submitしたジョブはrun_queueで順に実行し，
+    1つのジョブが失敗しても次のジョブに進む．ジョブの間も冷却は止めない．
+    """
+    def __init__(self, cl: ConfigLoader):
+        self.cl = cl
+
+        if self.cl.mode in HARDWARE_MODES:
+            folder = self.cl.folder
+            if not os.path.exists(folder):
+                os.mkdir(folder)
+
+        self.open_ports()
+
+        self.xpixels = 1024
+        self.spec_accumulated = None
+        self.spec_variance = None
+        self.spec_version = 0  # 新しいスペクトルを取得するたびに増やす
+        self.frames_used = 0  # 直前の取得で積算したフレーム数
+        self.accumulator = None
+        self.scan_file = None
+        self.journal = None
+        self.processor = None
+        self.processed = None  # 直前のスキャンの処理済みデータ(StreamProcessor)
+        self.writer = None
+        self.plan = None
+        self.fly = None
+        self.start = np.zeros(3)
+        self.goal = np.zeros(3)
+        self.travel_time = 0
+        self.trace = ScanTrace()  # スキャン中はファイルに書き出すものに差し替える
+        self.point = None  # 自動スキャンで測定中の点の番号
+        self.folder = self.cl.folder  # 実行中のジョブの保存先
+        self.jobs = queue.Queue()
+        self.cooled = False
+
+        # 進み具合を知らせる先．画面から差し替える
+        self.on_state = print  # スキャンの状態
+        self.on_message = ignore  # 撮影の状態
+        self.on_temperature = ignore  # 現在の温度 [℃]
+        self.on_progress = ignore  # 次に測る点の番号
+        self.on_scan_start = ignore  # 点数と画素数．スキャンを始める直前に呼ぶ
+        self.on_row = ignore  # 何点目(0始まり)かとそのスペクトル
+
+    def open_ports(self):
+        if self.cl.mode == 'RELEASE':
+            self.sdk = atmcd()
+            self.ser = serial.Serial(self.cl.port, self.cl.baudrate, timeout=self.cl.serial_timeout, write_timeout=0)
+            self.hsc = HSC103Controller(self.ser, poll_interval=self.cl.dt * 0.001)
+        elif self.cl.mode == 'SIMULATION':
+            # 疑似端末上の仮想ステージと仮想カメラ．通信と待ち時間は実機と同じ経路を通る
+            # 疑似端末のないWindowsでも実機のモードは動くよう，使うときだけ読み込む
+            from VirtualHSC103 import VirtualHSC103
+            from VirtualCamera import VirtualCamera
+            self.stage = VirtualHSC103(latency=self.cl.sim_latency)
+            self.sdk = VirtualCamera(self.stage, readout_time=self.cl.sim_readout_time, cosmic_rate=self.cl.sim_cosmic_rate)
+            self.ser = serial.Serial(self.stage.port, self.cl.baudrate, timeout=self.cl.serial_timeout, write_timeout=0)
+            self.hsc = HSC103Controller(self.ser, poll_interval=self.cl.dt * 0.001)
+        elif self.cl.mode == 'DEBUG':
+            self.sdk = EmptySdk()
+            self.ser = None
+            self.hsc = HSC103Controller(self.ser, poll_interval=self.cl.dt * 0.001)
+        else:
+            raise ValueError('Error with config.json. mode must be DEBUG, SIMULATION or RELEASE.')
+
+    def close(self):
+        if self.cl.mode in HARDWARE_MODES:
+            self.sdk.ShutDown()
+            self.hsc.close()
+            self.ser.close()
+        if self.cl.mode == 'SIMULATION':
+            self.stage.close()
+
+    def initialize(self):
+        # 初期化してcoolerをonにする
+        if self.cl.mode in HARDWARE_MODES:
+            ok = self.sdk.Initialize('') == atmcd_errors.Error_Codes.DRV_SUCCESS
+        else:
+            print('skipped initialization')
+            ok = True
+        self.sdk.SetTemperature(self.cl.temperature)
+        self.sdk.CoolerON()
+        return ok
+
+    def wait_for_cooling(self):
+        if self.cl.mode in HARDWARE_MODES:
+            while True:
+                ret, temperature = self.sdk.GetTemperature()
+                self.on_temperature(temperature)
+                if ret == atmcd_errors.Error_Codes.DRV_TEMP_STABILIZED:
+                    break
+                time.sleep(self.cl.dt * 0.001)
+        elif self.cl.mode == 'DEBUG':
+            print('skip updating temperature')
+        self.cooled = True
+
+    def stop(self):
+        self.hsc.stop_emergency()
+
+    def prepare_acquisition(self, job: ScanJob):
+        if self.cl.acquisition_mode != 'SINGLE':
+            self.prepare_series(job)
+        elif self.cl.mode in HARDWARE_MODES:
+            self.sdk.handle_return(self.sdk.SetAcquisitionMode(atmcd_codes.Acquisition_Mode.SINGLE_SCAN))
+            self.sdk.handle_return(self.sdk.SetReadMode(atmcd_codes.Read_Mode.FULL_VERTICAL_BINNING))
+            self.sdk.handle_return(self.sdk.SetTriggerMode(atmcd_codes.Trigger_Mode.INTERNAL))
+            ret, self.xpixels, ypixels = self.sdk.GetDetector()
+            self.sdk.handle_return(ret)
+            self.sdk.handle_return(self.sdk.SetExposureTime(job.exposure_time))
+            self.sdk.handle_return(self.sdk.PrepareAcquisition())
+        elif self.cl.mode == 'DEBUG':
+            print('prepare acquisition')
+            ret, self.xpixels, ypixels = self.sdk.GetDetector()
+        self.prepare_accumulator(job)
+
+    def prepare_accumulator(self, job: ScanJob):
+        # 1点分のフレームを溜めるバッファを露光前に確保しておく
+        number = job.accumulation_times
+        if job.snr_mode and self.cl.acquisition_mode == 'SINGLE':
+            # 上限時間内に撮れる枚数分
+            number = min(math.ceil(job.snr_time / job.exposure_time), self.cl.snr_max_frames)
+            number = max(number, 1)
+        if self.accumulator is None or self.accumulator.xpixels != self.xpixels or self.accumulator.max_frames != number:
+            self.accumulator = SpectrumAccumulator(self.xpixels, number, threshold=self.cl.rejection_threshold)
+
+    def finish_accumulation(self):
+        with self.trace.phase('process', self.point):
+            self.accumulator.compute()
+        # accumulatorのバッファは次の点で書き換わるので，画面や呼び出し側に渡すものはコピーする
+        if self.cl.spike_rejection:
+            self.spec_accumulated = self.accumulator.clipped_sum.copy()
+        else:
+            self.spec_accumulated = self.accumulator.sum.copy()
+        self.spec_variance = self.accumulator.variance.copy()
+        self.frames_used = self.accumulator.num
+        self.spec_version += 1
+
+    def prepare_series(self, job: ScanJob, mode=None, number=None):
+        # 積算・連続撮影の回数と周期をカメラに一度だけ設定する
+        if mode is None:
+            mode = self.cl.acquisition_mode
+        if number is None:
+            number = job.accumulation_times
+        if mode == 'ACCUMULATE':
+            self.sdk.handle_return(self.sdk.SetAcquisitionMode(atmcd_codes.Acquisition_Mode.ACCUMULATE))
+        elif mode == 'KINETICS':
+            self.sdk.handle_return(self.sdk.SetAcquisitionMode(atmcd_codes.Acquisition_Mode.KINETICS))
+        self.sdk.handle_return(self.sdk.SetReadMode(atmcd_codes.Read_Mode.FULL_VERTICAL_BINNING))
+        self.sdk.handle_return(self.sdk.SetTriggerMode(atmcd_codes.Trigger_Mode.INTERNAL))
+        ret, self.xpixels, ypixels = self.sdk.GetDetector()
+        self.sdk.handle_return(ret)
+        self.sdk.handle_return(self.sdk.SetExposureTime(job.exposure_time))
+        if mode == 'ACCUMULATE':
+            self.sdk.handle_return(self.sdk.SetNumberAccumulations(number))
+            self.sdk.handle_return(self.sdk.SetAccumulationCycleTime(self.cl.cycle_time))
+        elif mode == 'KINETICS':
+            self.sdk.handle_return(self.sdk.SetNumberAccumulations(1))
+            self.sdk.handle_return(self.sdk.SetNumberKinetics(number))
+            self.sdk.handle_return(self.sdk.SetKineticCycleTime(self.cl.cycle_time))
+        self.sdk.handle_return(self.sdk.PrepareAcquisition())
+
+    def wait_for_idle(self):
+        # 全フレームの取得が終わるまで待つ
+        while True:
+            self.sdk.handle_return(self.sdk.WaitForAcquisition())
+            ret, status = self.sdk.GetStatus()
+            if status != atmcd_errors.Error_Codes.DRV_ACQUIRING:
+                break
+
+    def acquire_series(self, job: ScanJob):
+        # 1回の撮影開始で積算・連続撮影を行い，まとめて読み出す
+        number = job.accumulation_times
+        self.on_message(f'Acquisition {number} frames')
+        with self.trace.phase('exposure', self.point):
+            self.sdk.handle_return(self.sdk.StartAcquisition())
+            self.wait_for_idle()
+        if self.cl.acquisition_mode == 'ACCUMULATE':
+            # カメラ内で積算済みなのでフレームごとのスパイク除去はできない
+            with self.trace.phase('readout', self.point):
+                ret, spec = self.sdk.GetAcquiredData(self.xpixels)
+            self.sdk.handle_return(ret)
+            self.spec_accumulated = np.array(spec)
+            self.frames_used = number
+            self.spec_version += 1
+        else:
+            with self.trace.phase('readout', self.point):
+                ret, data = self.sdk.GetAcquiredData(self.xpixels * number)
+            self.sdk.handle_return(ret)
+            self.accumulator.reset()
+            self.accumulator.add_series(data)
+            self.finish_accumulation()
+        self.on_message('Finished Acquisition')
+
+    def acquire(self, job: ScanJob):
+        # SN比モードはSINGLEのときだけ．積算・連続撮影ではvalidateで弾いている
+        if self.cl.acquisition_mode != 'SINGLE':
+            self.acquire_series(job)
+            return
+        if job.snr_mode:
+            self.acquire_until_snr(job)
+            return
+        self.accumulator.reset()
+        for i in range(job.accumulation_times):
+            self.on_message(f'Acquisition {i + 1}/{job.accumulation_times}')
+            self.accumulator.add(self.acquire_frame())
+        self.finish_accumulation()
+        self.on_message('Finished Acquisition')
+
+    def acquire_frame(self):
+        if self.cl.mode in HARDWARE_MODES:
+            with self.trace.phase('exposure', self.point):
+                self.sdk.handle_return(self.sdk.StartAcquisition())
+                self.sdk.handle_return(self.sdk.WaitForAcquisition())
+            with self.trace.phase('readout', self.point):
+                ret, spec, first, last = self.sdk.GetImages16(1, 1, self.xpixels)
+            self.sdk.handle_return(ret)
+        elif self.cl.mode == 'DEBUG':
+            print('acquired')
+            spec = np.sin(np.linspace(0, np.random.rand() * 10, 100))
+            with self.trace.phase('exposure', self.point):
+                time.sleep(0.5)
+        return spec
+
+    def acquire_until_snr(self, job: ScanJob):
+        # 1枚撮るごとにSN比を確かめ，目標に届くか上限時間を超えたら終わる
+        region = slice(*job.snr_region)
+        t_end = time.time() + job.snr_time
+        self.accumulator.reset()
+        while self.accumulator.num < self.accumulator.max_frames:
+            self.accumulator.add(self.acquire_frame())
+            snr = self.accumulator.snr(region)
+            self.on_message(f'Acquisition {self.accumulator.num}: SNR {snr:.1f}/{job.snr_target}')
+            if snr >= job.snr_target or time.time() >= t_end:
+                break
+        self.finish_accumulation()
+        self.on_message('Finished Acquisition')
+
+    def save_as_sif(self, path):
+        if self.cl.mode in HARDWARE_MODES:
+            self.sdk.handle_return(self.sdk.SaveAsSif(path))
+        elif self.cl.mode == 'DEBUG':
+            print('saved')
+
+    def save_as_asc(self, path):
+        if self.cl.mode in HARDWARE_MODES:
+            spec_str = list(map(lambda x: str(x) + '\n', self.spec_accumulated))
+            with open(path, 'w') as f:
+                f.writelines(spec_str)
+        elif self.cl.mode == 'DEBUG':
+            print('saved')
+
+    def wait_for_stage(self):
+        # ステージの到着を確認してから次に進む
+        if self.hsc.wait_until_ready(settle=self.cl.settle_time, timeout=self.cl.move_timeout):
+            return True
+        self.on_state('Stage did not arrive. Auto scan stopped.')
+        return False
+
+    def submit(self, job: ScanJob):
+        self.jobs.put(job)
+
+    def run_queue(self):
+        """
+        溜まっているジョブを順に実行する．失敗したジョブは飛ばして次に進む．
+        Returns:
+            results (list): (ジョブ, 成功したか)のリスト．
+        """
+        results = []
+        while not self.jobs.empty():
+            job = self.jobs.get()
+            self.on_state(f'Job {len(results) + 1}: {job.name or job.mode}')
+            try:
+                ok = self.run_job(job)
+            except Exception as e:
+                self.hsc.stop_emergency()
+                self.on_state(f'Job failed: {e}')
+                ok = False
+            results.append((job, ok))
+        return results
+
+    def run_job(self, job: ScanJob, journal_path: str = None):
+        """
+        1つのスキャンを最後まで行う．呼んだスレッドで実行するので，画面からは別スレッドで呼ぶ．
+        Args:
+            job (ScanJob): スキャンの設定．
+            journal_path (str): 再開するスキャンの記録．Noneなら新しく始める．
+
+        Returns:
+            ok (bool): 最後まで測定できたか．
+        """
+        error = job.validate(self.cl.acquisition_mode)
+        if error is not None:
+            self.on_state(error)
+            return False
+        self.on_state('Setting up...')
+        self.start = np.array(job.start) / UM_PER_PULSE
+        self.goal = np.array(job.goal) / UM_PER_PULSE
+        if job.mode == 'Fly' and journal_path is not None:
+            self.on_state('Fly scans cannot be resumed')
+            return False
+        try:
+            if job.mode == 'Fly':
+                return self.run_fly_scan(job)
+            return self.run_step_scan(job, journal_path)
+        except Exception as e:
+            # 測定のループに入る前(露光の設定，最初の移動，ファイルを開くところ)で失敗したとき
+            self.hsc.stop_emergency()
+            self.on_state(f'Auto scan stopped: {e}')
+            return False
+
+    def resume(self, journal_path: str):
+        """
+        止まったスキャンを記録から再開する．記録にある点は測り直さず，最初の抜けている点から続きを同じファイルに追記する．
+        Args:
+            journal_path (str): 記録(.journal)のファイル名．
+
+        Returns:
+            ok (bool): 最後まで測定できたか．
+        """
+        try:
+            header, points, finished = ScanJournal.read(journal_path)
+            job = ScanJob.from_dict(header['job'])
+        except (OSError, ValueError, KeyError) as e:
+            self.on_state(f'Cannot resume: {e}')
+            return False
+        if finished:
+            self.on_state('Scan already finished')
+            return True
+        job.folder = os.path.dirname(os.path.abspath(journal_path))
+        return self.run_job(job, journal_path)
+
+    def load_journal(self, journal_path: str):
+        """
+        記録にある点とそのスペクトルを読む．
+        Returns:
+            points (list(dict)): 測り終えた点の記録．
+            spectra (list(np.ndarray)): 各点のスペクトル．
+        """
+        header, points, finished = ScanJournal.read(journal_path)
+        scan = ScanFile.open(os.path.join(os.path.dirname(os.path.abspath(journal_path)), header['scan_file']))
+        spectra = []
+        for i, point in enumerate(points):
+            if point['index'] != i or point['offset'] != scan.header_len + i * scan.dtype.itemsize or i >= len(scan.records):
+                raise ValueError(f'{journal_path} does not match {scan.path}')
+            spectra.append(np.array(scan.spectra[i]))
+        return points, spectra
+
+    def make_plan(self, job: ScanJob):
+        if job.mode == 'Grid':
+            return ScanPlan.grid(self.start, self.goal, list(job.steps))
+        if job.mode == 'Points':
+            # 各軸の速度の逆数で重みをつけ，移動時間が短くなる順に並べる．再開しても同じ順になるよう現在位置ではなくstartから
+            weights = [1 / speed[1] for speed in self.hsc.speeds]
+            return ScanPlan.from_points(np.array(job.points) / UM_PER_PULSE, start=self.start, weights=weights)
+        if job.mode == 'Adaptive':
+            # 回数で粗く測定し，上限の点数まで変化の大きい所に点を足す
+            return AdaptiveLinePlan(self.start, self.goal, int(job.steps), job.budget,
+                                    tolerance=self.cl.adaptive_tolerance, min_spacing=self.cl.adaptive_spacing / UM_PER_PULSE)
+        return ScanPlan.line(self.start, self.goal, int(job.steps))
+
+    def run_step_scan(self, job: ScanJob, journal_path: str = None):
+        self.prepare_acquisition(job)
+
+        self.hsc.set_speed_max()
+        self.plan = self.make_plan(job)
+        self.travel_time = self.plan.estimate_travel_time(self.hsc.speeds, settle=self.cl.settle_time)
+        print(f'{len(self.plan)} points, estimated travel time: {self.travel_time:.1f} s')
+
+        # 再開するときは記録にある点の結果を計画に渡し直し，最初の抜けている点まで進める
+        try:
+            points, spectra = self.load_journal(journal_path) if journal_path is not None else ([], [])
+        except (OSError, ValueError, KeyError) as e:
+            self.on_state(f'Cannot resume: {e}')
+            return False
+        self.plan.reset()
+        point = self.plan.next_point()
+        for record, spectrum in zip(points, spectra):
+            if point is None or not np.allclose(point * UM_PER_PULSE, record['commanded']):
+                self.on_state('Journal does not match the scan plan.')
+                return False
+            self.plan.add_result(point, spectrum)
+            point = self.plan.next_point()
+        number = len(points) + 1
+        if point is None:
+            self.on_state('Auto Acquisition Finished')
+            return True
+
+        # 最初に測る点に移動
+        self.hsc.move_abs(point)
+        if not self.wait_for_stage():
+            return False
+
+        step = len(self.plan)
+        self.on_scan_start(step, self.xpixels)
+        for i, spectrum in enumerate(spectra):
+            self.on_row(i, spectrum)
+        self.on_progress(number)
+        self.open_scan_file(job, journal_path, len(points))
+        self.writer = BackgroundWriter()
+        ok = False
+        try:
+            for i, (record, spectrum) in enumerate(zip(points, spectra)):
+                self.processor.submit(i, spectrum, record['commanded'], record['timestamp'])
+            while point is not None:
+                self.point = number
+                self.on_state(f'Acquisition {number} of {step}... {self.trace.format_eta(step - number + 1)}')
+
+                with self.trace.phase('arrival', number):
+                    arrived = self.wait_for_stage()
+                if not arrived:
+                    break
+                measured = self.hsc.query_position().result(timeout=self.cl.move_timeout)
+
+                self.acquire(job)
+                spectrum = self.spec_accumulated
+                timestamp = time.time()  # 書き込みは後で別スレッドが行うので，撮り終えた時刻をここで取る
+
+                # 読み出しが終わったらすぐに次の点へ移動を始める
+                self.plan.add_result(point, spectrum)
+                next_point = self.plan.next_point()
+                if next_point is not None:
+                    self.trace.track(self.hsc.move_abs(next_point), 'move_command', number + 1)
+
+                self.on_row(number - 1, spectrum)
+
+                # 書き込みと宇宙線除去は移動・露光と並行して別スレッドで行う．生データの書き込みを先に予約する
+                self.writer.submit(self.save_to_scan_file, spectrum, point * UM_PER_PULSE, number, timestamp, self.frames_used,
+                                   None if measured is None else np.array(measured) * UM_PER_PULSE)
+                self.processor.submit(number - 1, spectrum, point * UM_PER_PULSE, timestamp, self.frames_used)
+
+                self.on_progress(number + 1)
+                self.trace.point_done()
+                point = next_point
+                number += 1
+            else:
+                self.on_state('Auto Acquisition Finished')
+                ok = True
+            self.writer.close()
+        except Exception as e:
+            self.hsc.stop_emergency()
+            self.on_state(f'Auto scan stopped: {e}')
+            ok = False
+            try:
+                self.writer.close()  # 予約済みの書き込みを吐き出す
+            except Exception as e_write:
+                print('failed in writing:', e_write)
+
+        self.point = None
+        self.close_scan_file(ok)
+        self.show_trace_summary()
+        return ok
+
+    def run_fly_scan(self, job: ScanJob):
+        # 一定速度で動かしながら連続撮影する．1フレームが1点になる
+        number = int(job.steps)
+        self.prepare_series(job, 'KINETICS', number)
+        ret, exposure, accumulate, kinetic = self.sdk.GetAcquisitionTimings()
+        self.sdk.handle_return(ret)
+
+        self.fly = FlyScan(self.start, self.goal, number, kinetic, exposure)
+        if not self.fly.is_feasible():
+            self.on_state('Too fast. Increase steps or exposure time.')
+            return False
+        self.plan = ScanPlan.line(self.start, self.goal, number)
+        self.plan.kind = 'fly'
+        self.travel_time = self.fly.duration
+
+        self.hsc.set_speed_max()
+        self.hsc.move_abs(self.start)
+        if not self.wait_for_stage():
+            return False
+
+        self.on_scan_start(number, self.xpixels)
+        self.on_progress(1)
+        spectra = np.zeros((number, self.xpixels))
+        poll_interval = self.hsc.poll_interval
+        self.open_scan_file(job)
+        self.writer = BackgroundWriter()
+        ok = False
+        try:
+            # 位置の記録を細かくしてから，移動と撮影を同時に始める
+            self.hsc.poll_interval = max(min(poll_interval, self.fly.cycle_time / 2), MIN_POLL_INTERVAL)
+            for speed in self.fly.get_speeds():
+                self.hsc.set_speed(speed)
+            self.trace.track(self.hsc.move_linear(list(self.goal - self.start)), 'move_command').result(timeout=self.cl.move_timeout)
+            t_move = time.time()
+            self.sdk.handle_return(self.sdk.StartAcquisition())
+            t_acquisition = time.time()
+            for i in range(number):
+                self.on_state(f'Fly scan {i + 1} of {number}... {self.trace.format_eta(number - i)}')
+                with self.trace.phase('exposure', i + 1):
+                    self.sdk.handle_return(self.sdk.WaitForAcquisition())
+                with self.trace.phase('readout', i + 1):
+                    ret, spec, first, last = self.sdk.GetImages16(i + 1, i + 1, self.xpixels)
+                self.sdk.handle_return(ret)
+                self.trace.point_done()
+                spectra[i] = spec
+                self.spec_accumulated = spectra[i]
+                self.spec_version += 1
+                self.on_row(i, spectra[i])
+                self.on_progress(i + 2)
+            with self.trace.phase('arrival'):
+                self.wait_for_stage()
+            self.hsc.poll_interval = poll_interval
+            self.hsc.set_speed_max()
+
+            # 露光の中心時刻での位置を求め，記録した位置で補正する
+            times = self.fly.frame_times(t_acquisition)
+            positions = self.fly.model_positions(times, t_move)
+            corrected = self.fly.correct_positions(times, positions, self.hsc.get_position_history())
+            for i in range(number):
+                # 位置は撮り終えてから決まるので，書き込みと処理もここで予約する
+                self.writer.submit(self.save_to_scan_file, spectra[i], corrected[i] * UM_PER_PULSE, i + 1, times[i], 1,
+                                   corrected[i] * UM_PER_PULSE, positions[i] * UM_PER_PULSE)
+                self.processor.submit(i, spectra[i], corrected[i] * UM_PER_PULSE, times[i], 1)
+            self.writer.close()
+            self.on_state('Fly Scan Finished')
+            ok = True
+        except Exception as e:
+            self.hsc.stop_emergency()
+            self.hsc.poll_interval = poll_interval
+            self.on_state(f'Fly scan stopped: {e}')
+            try:
+                self.writer.close()
+            except Exception as e_write:
+                print('failed in writing:', e_write)
+
+        self.close_scan_file(ok)
+        self.show_trace_summary()
+        return ok
+
+    def get_folder(self, job: ScanJob):
+        folder = job.folder or self.cl.folder
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        return folder
+
+    def get_scan_settings(self, job: ScanJob):
+        return {
+            'mode': self.cl.mode,
+            'job': job.name,
+            'exposure_time': job.exposure_time,
+            'accumulation_times': job.accumulation_times,
+            'snr_mode': job.snr_mode,
+            'snr_target': job.snr_target,
+            'snr_region': job.snr_region,
+            'snr_time': job.snr_time,
+            'max_step': len(self.plan),
+            'plan': self.plan.kind,
+            'shape': self.plan.shape,
+            'estimated_travel_time': self.travel_time,
+            'temperature': self.cl.temperature,
+            'start': list(self.start * UM_PER_PULSE),
+            'goal': list(self.goal * UM_PER_PULSE),
+            'center': job.center,
+            'calibration': None if job.calibration is None else os.path.abspath(job.calibration),  # 後から校正するときに使う
+        }
+
+    def get_scan_name(self, job: ScanJob):
+        # 続けて実行したジョブが同じ秒に始まっても上書きしないよう番号をつける
+        base = time.strftime('scan_%Y%m%d_%H%M%S')
+        if job.name:
+            base += f'_{job.name}'
+        name = os.path.join(self.folder, base)
+        i = 1
+        while os.path.exists(name + EXTENSION):
+            name = os.path.join(self.folder, f'{base}_{i}')
+            i += 1
+        return name
+
+    def open_scan_file(self, job: ScanJob, journal_path: str = None, num: int = 0):
+        """
+        1スキャンを1ファイルにまとめ，1点ごとに追記する．測り終えた点は同じ名前の記録(.journal)にも追記する．
+        各段階の所要時間も同じ名前のトレースファイルに記録する．
+        Args:
+            job (ScanJob): スキャンの設定．
+            journal_path (str): 再開するスキャンの記録．Noneなら新しく作る．
+            num (int): 再開するときに記録にある点の数．スキャンファイルの残りは切り捨てる．
+        """
+        if self.cl.mode in HARDWARE_MODES:
+            self.folder = self.get_folder(job)
+            if journal_path is None:
+                self.scan_name = self.get_scan_name(job)
+                self.scan_file = ScanFile.create(self.scan_name + EXTENSION, self.xpixels, settings=self.get_scan_settings(job))
+                header = {'job': job.to_dict(), 'scan_file': os.path.basename(self.scan_file.path)}
+                self.journal = ScanJournal.create(self.scan_name + JOURNAL_EXTENSION, header, dependents=[self.scan_file.f])
+                self.trace = ScanTrace(self.scan_name + TRACE_EXTENSION)
+            else:
+                self.scan_name = os.path.splitext(os.path.abspath(journal_path))[0]
+                self.scan_file = ScanFile.open_append(self.scan_name + EXTENSION, num)
+                self.journal = ScanJournal.open_append(journal_path, dependents=[self.scan_file.f])
+                self.trace = ScanTrace(self.scan_name + time.strftime('_resumed_%Y%m%d_%H%M%S') + TRACE_EXTENSION)
+        elif self.cl.mode == 'DEBUG':
+            print('scan file opened')
+            self.trace = ScanTrace()
+        self.open_processor(job)
+
+    def open_processor(self, job: ScanJob):
+        # 処理済みのデータはスキャンファイルから作り直せるので，再開したときも最初から書き直す
+        path = None
+        settings = None
+        if self.cl.mode in HARDWARE_MODES:
+            path = self.scan_name + PROCESSED_SUFFIX + EXTENSION
+            settings = self.get_scan_settings(job)
+        self.processor = StreamProcessor(self.xpixels, len(self.plan), center=job.center, calibration_path=job.calibration,
+                                         passes=self.cl.spike_removal_passes, path=path, settings=settings,
+                                         cache_path=self.cl.calibration_cache)
+
+    def save_to_scan_file(self, spectrum, location, number, timestamp=None, frames=0, measured=None, commanded=None):
+        # 書き込んだ後で記録に追記するので，記録にある点のスペクトルは必ずファイルにある
+        if commanded is None:
+            commanded = location
+        if self.cl.mode in HARDWARE_MODES:
+            with self.trace.phase('save_spectrum', number):
+                offset = self.scan_file.append(spectrum, location, timestamp=timestamp, index=number - 1, frames=frames)
+                self.scan_file.flush()
+            with self.trace.phase('save_location', number):
+                self.journal.add_point(number - 1, commanded, measured, offset, timestamp)
+        elif self.cl.mode == 'DEBUG':
+            print('saved')
+
+    def close_scan_file(self, finished: bool = True):
+        # 最後まで測れなかった場合は終わりの印をつけずに閉じ，resumeで再開できるようにする
+        self.trace.close()
+        if self.processor is not None:
+            try:
+                self.processor.close()
+                self.processed = self.processor
+            except Exception as e:
+                print('failed in processing:', e)
+            self.processor = None
+        if self.scan_file is None:
+            return
+        if finished:
+            self.journal.finish()
+        else:
+            self.journal.close()
+        self.scan_file.close()
+        if finished and self.cl.save_asc:
+            # 従来形式の.ascとlocation.csvをスキャンと同じ名前のフォルダにまとめて書き出す
+            folder = self.scan_name
+            if not os.path.exists(folder):
+                os.mkdir(folder)
+            ScanFile.open(self.scan_file.path).to_asc(folder)
+            ScanJournal.to_csv(self.journal.path, os.path.join(folder, 'location.csv'))
+        self.scan_file = None
+        self.journal = None
+
+    def show_trace_summary(self):
+        # スキャン全体の時間の内訳
+        summary = self.trace.format_summary()
+        print(summary)
+        self.on_message(summary)
+
+
+def load_recipe(path: str):
+    """
+    レシピを読む．{"jobs": [...]}か，ジョブのリストそのもの．
+    拡張子が.yamlか.ymlならYAMLとして読む(PyYAMLが必要)．
+    Args:
+        path (str): レシピのファイル名．
+
+    Returns:
+        jobs (list(ScanJob)): 書かれた順のジョブ．
+    """
+    with open(path, 'r') as f:
+        if os.path.splitext(path)[1] in ['.yaml', '.yml']:
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError('PyYAML is required to read YAML recipes. Use a JSON recipe instead.')
+            recipe = yaml.safe_load(f)
+        else:
+            recipe = json.load(f)
+    if isinstance(recipe, dict):
+        recipe = recipe['jobs']
+    return [ScanJob.from_dict(d) for d in recipe]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run scans written in a recipe without the window.')
+    parser.add_argument('recipe', nargs='?', help='JSON or YAML file with a list of jobs')
+    parser.add_argument('--resume', nargs='*', default=[], help='journal files of interrupted scans to continue first')
+    parser.add_argument('--config', default='./config.json')
+    args = parser.parse_args()
+    if args.recipe is None and not args.resume:
+        parser.error('give a recipe or --resume')
+
+    jobs = load_recipe(args.recipe) if args.recipe is not None else []
+    engine = ScanEngine(ConfigLoader(args.config))
+    if not engine.initialize():
+        print('Initialization failed')
+        engine.close()
+        return
+    engine.on_temperature = lambda temperature: print(f'{temperature}℃')
+    try:
+        engine.wait_for_cooling()
+        # 1つの記録やジョブが失敗しても残りは続ける
+        for path in args.resume:
+            try:
+                ok = engine.resume(path)
+            except Exception as e:
+                engine.hsc.stop_emergency()
+                print(f'Resume {path}: {e}')
+                ok = False
+            print(f'Resume {path}:', 'done' if ok else 'failed')
+        for job in jobs:
+            engine.submit(job)
+        results = engine.run_queue()
+        for i, (job, ok) in enumerate(results):
+            print(f'Job {i + 1} ({job.name or job.mode}):', 'done' if ok else 'failed')
+    finally:
+        engine.close()
+
+
+if __name__ == '__main__':
+    main()
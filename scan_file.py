@@ -0,0 +1,226 @@
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+MAGIC = b'RASCAN01'
+HEADER_ALIGN = 64
+EXTENSION = '.rscan'
+
+
+def record_dtype(pixels: int, dtype='<f8'):
+    fields = [
+        ('index', '<i8', []),
+        ('position', '<f8', [3]),
+        ('timestamp', '<f8', []),
+        ('frames', '<i4', []),  # 積算したフレーム数
+        ('spectrum', np.dtype(dtype).str, [pixels]),
+    ]
+    return fields
+
+
+def fields_to_dtype(fields: list):
+    return np.dtype([(name, dtype, tuple(shape)) for name, dtype, shape in fields])
+
+
+class ScanFile:
+    """
+    1スキャン分のスペクトル・ステージ座標・時刻・取得条件をまとめて保存するバイナリファイル．
+    ヘッダ(MAGIC, ヘッダ長, JSON)の後ろに固定長のレコードを1点ごとに追記していく．
+    読み込み時はレコード部分をnp.memmapで開くので，スキャン全体をコピーなしで扱える．
+    """
+    def __init__(self, path: str, header: dict, header_len: int, f=None):
+        self.path = path
+        self.header = header
+        self.header_len = header_len
+        self.settings = header['settings']
+        self.dtype = fields_to_dtype(header['fields'])
+        self.f = f  # 追記用に開いている場合のみ
+        self.record = np.zeros(1, dtype=self.dtype)
+        self.records = None
+
+    @classmethod
+    def create(cls, path: str, pixels: int, settings: dict = None, dtype='<f8'):
+        header = {
+            'version': 1,
+            'created': time.time(),
+            'fields': record_dtype(pixels, dtype),
+            'settings': settings if settings is not None else {},
+        }
+        body = json.dumps(header, ensure_ascii=False).encode()
+        header_len = len(MAGIC) + 8 + len(body)
+        header_len += -header_len % HEADER_ALIGN  # レコードの先頭を揃える
+        body += b' ' * (header_len - len(MAGIC) - 8 - len(body))
+
+        f = open(path, 'wb')
+        f.write(MAGIC)
+        f.write(np.uint64(header_len).tobytes())
+        f.write(body)
+        f.flush()
+        return cls(path, header, header_len, f)
+
+    @classmethod
+    def open(cls, path: str):
+        header, header_len = cls.read_header(path)
+        scan = cls(path, header, header_len)
+        scan.map()
+        return scan
+
+    @classmethod
+    def open_append(cls, path: str, num: int = None):
+        """
+        途中で止まったスキャンの続きを追記するために開く．
+        Args:
+            path (str): スキャンファイル名．
+            num (int): 残すレコード数．Noneなら書きかけの末尾レコードだけを切り捨てる．
+
+        Returns:
+            scan (ScanFile): 追記用に開いたファイル．
+        """
+        header, header_len = cls.read_header(path)
+        scan = cls(path, header, header_len)
+        if num is None:
+            num = (os.path.getsize(path) - header_len) // scan.dtype.itemsize
+        f = open(path, 'r+b')
+        f.truncate(header_len + num * scan.dtype.itemsize)
+        f.seek(0, os.SEEK_END)
+        scan.f = f
+        return scan
+
+    @staticmethod
+    def read_header(path: str):
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a scan file.')
+            header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            header = json.loads(f.read(header_len - len(MAGIC) - 8).decode())
+        return header, header_len
+
+    def map(self):
+        # 書きかけの末尾レコードは無視する
+        num = (os.path.getsize(self.path) - self.header_len) // self.dtype.itemsize
+        if num == 0:
+            self.records = np.zeros(0, dtype=self.dtype)
+        else:
+            self.records = np.memmap(self.path, dtype=self.dtype, mode='r', offset=self.header_len, shape=(num,))
+        return self.records
+
+    def append(self, spectrum, position, timestamp: float = None, index: int = None, frames: int = 0):
+        # 書き込んだレコードのファイル内の位置を返す
+        if self.f is None:
+            raise ValueError('Scan file is not opened for writing.')
+        offset = self.f.tell()
+        record = self.record[0]
+        record['index'] = len(self) if index is None else index
+        record['position'] = position
+        record['timestamp'] = time.time() if timestamp is None else timestamp
+        if 'frames' in self.dtype.names:
+            record['frames'] = frames
+        record['spectrum'] = spectrum
+        self.f.write(self.record.tobytes())
+        return offset
+
+    def flush(self):
+        if self.f is not None:
+            self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        if self.f is not None:
+            return (self.f.tell() - self.header_len) // self.dtype.itemsize
+        return len(self.records)
+
+    @property
+    def spectra(self):
+        return self.records['spectrum']
+
+    @property
+    def positions(self):
+        return self.records['position']
+
+    @property
+    def timestamps(self):
+        return self.records['timestamp']
+
+    def to_asc(self, folder: str):
+        # 従来の{number}of{step}.asc形式に書き出す
+        if self.records is None:
+            self.map()
+        step = self.settings.get('max_step', len(self.records))
+        for number, spectrum in enumerate(self.spectra, start=1):
+            spec_str = list(map(lambda x: str(x) + '\n', spectrum.tolist()))
+            with open(os.path.join(folder, f'{number}of{step}.asc'), 'w') as f:
+                f.writelines(spec_str)
+
+
+class BackgroundWriter:
+    """
+    ファイル書き込みを別スレッドで順番に実行する．
+    スキャン中はsubmitで書き込みを予約し，測定はそのまま次の点へ進む．
+    書き込み中に起きた例外は次のsubmitかcloseで送出する．
+    """
+    def __init__(self, maxsize: int = 0):
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:  # 終了の合図
+                self.queue.task_done()
+                break
+            func, args = item
+            if self.error is None:  # 失敗した後の書き込みは捨てる
+                try:
+                    func(*args)
+                except Exception as e:
+                    self.error = e
+            self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, func, *args):
+        self.raise_error()
+        self.queue.put((func, args))
+
+    def flush(self):
+        # 予約済みの書き込みがすべて終わるまで待つ
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.raise_error()
+
+
+def main():
+    path = 'test' + EXTENSION
+    with ScanFile.create(path, 1024, settings={'exposure_time': 1}) as scan:
+        for i in range(10):
+            scan.append(np.random.rand(1024), [i, 0, 0])
+    scan = ScanFile.open(path)
+    print(scan.settings, scan.spectra.shape, scan.positions[:, 0])
+
+
+if __name__ == '__main__':
+    main()
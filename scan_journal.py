@@ -0,0 +1,118 @@
+import json
+import os
+import time
+
+JOURNAL_EXTENSION = '.journal'
+
+
+class ScanJournal:
+    """
+    スキャンの進み具合を1点1行のJSONで追記していく記録．
+    1行目はジョブの設定，その後に測り終えた点を(番号，指令位置，実測位置，スキャンファイル内の位置，時刻)で書く．
+    追記だけなので書き込み中に落ちても壊れるのは最後の1行だけで，読むときはそれを無視する．
+    fsyncはsync_every点ごとかsync_interval秒ごとにまとめて行い，先にdependents(スキャンファイル)をfsyncしてから
+    記録をfsyncするので，記録にある点のスペクトルは必ずディスクにある．
+    """
+    def __init__(self, path: str, f, sync_every: int = 10, sync_interval: float = 5.0, dependents: list = None):
+        self.path = path
+        self.f = f
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.dependents = dependents if dependents is not None else []  # 記録より先にfsyncするファイル
+        self.num_unsynced = 0
+        self.t_synced = time.time()
+
+    @classmethod
+    def create(cls, path: str, header: dict, **kwargs):
+        journal = cls(path, open(path, 'w'), **kwargs)
+        journal.write(dict(header, type='header', created=time.time()))
+        journal.sync()
+        return journal
+
+    @classmethod
+    def open_append(cls, path: str, **kwargs):
+        # 書きかけの最後の行を切り捨ててから追記する
+        with open(path, 'rb') as f:
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        f = open(path, 'r+')
+        f.truncate(end)
+        f.seek(end)
+        return cls(path, f, **kwargs)
+
+    @staticmethod
+    def read(path: str):
+        """
+        Args:
+            path (str): 記録のファイル名．
+
+        Returns:
+            header (dict): 1行目のジョブの設定．
+            points (list(dict)): 測り終えた点の記録．書いた順．
+            finished (bool): スキャンが最後まで終わっていればTrue．
+        """
+        header = None
+        points = []
+        finished = False
+        with open(path, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # 改行のない最後の行はJSONとして読めても書きかけ．open_appendも切り捨てる
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # 書きかけの行
+                if entry['type'] == 'header':
+                    header = entry
+                elif entry['type'] == 'point':
+                    points.append(entry)
+                elif entry['type'] == 'end':
+                    finished = True
+        if header is None:
+            raise ValueError(f'{path} is not a scan journal.')
+        return header, points, finished
+
+    def write(self, entry: dict):
+        self.f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    def add_point(self, index: int, commanded, measured, offset: int, timestamp: float = None):
+        self.write({
+            'type': 'point',
+            'index': index,
+            'commanded': [float(v) for v in commanded],
+            'measured': None if measured is None else [float(v) for v in measured],
+            'offset': offset,
+            'timestamp': time.time() if timestamp is None else timestamp,
+        })
+        self.num_unsynced += 1
+        if self.num_unsynced >= self.sync_every or time.time() - self.t_synced >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        for f in self.dependents:
+            f.flush()
+            os.fsync(f.fileno())
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.num_unsynced = 0
+        self.t_synced = time.time()
+
+    def finish(self):
+        self.write({'type': 'end', 'timestamp': time.time()})
+        self.close()
+
+    def close(self):
+        if self.f is None:
+            return
+        self.sync()
+        self.f.close()
+        self.f = None
+
+    @staticmethod
+    def to_csv(path: str, csv_path: str):
+        # 従来のlocation.csvと同じ形式に書き出す
+        header, points, finished = ScanJournal.read(path)
+        with open(csv_path, 'w') as f:
+            f.write('x,y,z\n')
+            for point in points:
+                f.write(','.join(str(v) for v in point['commanded']) + '\n')
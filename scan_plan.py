@@ -0,0 +1,272 @@
+import numpy as np
+
+
+def move_time(distance, start: float, final: float, rate: float):
+    """
+    台形の速度パターンで1軸をdistance [pulse]動かすのにかかる時間．
+    Args:
+        distance (float or np.ndarray): 移動量 [pulse]．
+        start (float): 初速度 [pulse/s]．
+        final (float): 最大速度 [pulse/s]．
+        rate (float): 最大速度に到達するまでの時間 [ms]．
+
+    Returns:
+        t (float or np.ndarray): 移動時間 [s]．
+    """
+    distance = np.abs(distance)
+    if final <= start:
+        return distance / final
+    acceleration = (final - start) / (rate * 0.001)
+    distance_acc = (final ** 2 - start ** 2) / (2 * acceleration)  # 加速にかかる距離
+    t_full = 2 * (final - start) / acceleration + (distance - 2 * distance_acc) / final
+    v_peak = np.sqrt(start ** 2 + acceleration * distance)  # 最大速度に届かない場合
+    t_short = 2 * (v_peak - start) / acceleration
+    return np.where(distance >= 2 * distance_acc, t_full, t_short)
+
+
+def serpentine_order(shape):
+    """
+    (z, y, x)の格子を往復しながらたどる順番．xの向きは1行ごと，yの向きは1面ごとに反転させる．
+    """
+    nz, ny, nx = shape
+    order = []
+    row = 0
+    for k in range(nz):
+        ys = range(ny) if k % 2 == 0 else range(ny - 1, -1, -1)
+        for j in ys:
+            xs = range(nx) if row % 2 == 0 else range(nx - 1, -1, -1)
+            order += [(k, j, i) for i in xs]
+            row += 1
+    return order
+
+
+class ScanPlan:
+    """
+    自動スキャンで測定する点[pulse]とその順番．
+    """
+    def __init__(self, points, shape=None, kind='points'):
+        self.points = np.asarray(points, dtype=float).reshape(-1, 3)
+        self.shape = shape  # 格子の場合は(z, y, x)の点数
+        self.kind = kind
+        self.cursor = 0
+
+    def __len__(self):
+        return len(self.points)
+
+    def __getitem__(self, index):
+        return self.points[index]
+
+    def __iter__(self):
+        return iter(self.points)
+
+    def reset(self):
+        self.cursor = 0
+
+    def next_point(self):
+        # 次に測定する点．最後まで測定したらNone
+        if self.cursor >= len(self.points):
+            return None
+        self.cursor += 1
+        return self.points[self.cursor - 1]
+
+    def add_result(self, point, spectrum):
+        # 測定結果で次の点が変わることはない
+        pass
+
+    @classmethod
+    def line(cls, start, goal, step: int):
+        # start-goal間をstep点に等分する
+        start = np.asarray(start, dtype=float)
+        goal = np.asarray(goal, dtype=float)
+        ratio = np.arange(step) / max(step - 1, 1)
+        return cls(start + (goal - start) * ratio[:, None], kind='line')
+
+    @classmethod
+    def grid(cls, start, goal, steps: list, serpentine: bool = True):
+        """
+        startとgoalを対角とする直方体の格子．
+        Args:
+            start (list(float)): 角の座標 [pulse]．
+            goal (list(float)): 反対側の角の座標 [pulse]．
+            steps (list(int)): x, y, z方向の点数．2次元の場合はどれかを1にする．
+            serpentine (bool): Trueなら往復しながら測定する．Falseなら毎行xの端に戻る．
+        """
+        if len(steps) != 3 or min(steps) < 1:
+            raise ValueError('steps must contain three positive integers')
+        axes = [np.linspace(s, g, n) if n > 1 else np.array([s]) for s, g, n in zip(start, goal, steps)]
+        shape = (steps[2], steps[1], steps[0])
+        if serpentine:
+            order = serpentine_order(shape)
+        else:
+            order = [(k, j, i) for k in range(shape[0]) for j in range(shape[1]) for i in range(shape[2])]
+        points = [[axes[0][i], axes[1][j], axes[2][k]] for k, j, i in order]
+        return cls(points, shape=shape, kind='grid')
+
+    @classmethod
+    def from_points(cls, points, start=None, weights=None, two_opt: bool = True):
+        """
+        任意の点の集まりを移動量が小さくなる順に並べる．最近傍法で並べてから2-optで改善する．
+        Args:
+            points (array-like): (N, 3)の座標 [pulse]．
+            start (list(float)): 現在位置．Noneなら最初の点から始める．
+            weights (list(float)): 軸ごとの重み．各軸の速度の逆数を与えると移動時間の近似になる．
+            two_opt (bool): 2-optによる改善を行うか．
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        weights = np.ones(3) if weights is None else np.asarray(weights, dtype=float)
+        order = nearest_neighbour_order(points, start, weights)
+        if two_opt:
+            order = two_opt_order(points, order, start, weights)
+        return cls(points[order], kind='points')
+
+    def path(self, start=None):
+        if start is None:
+            return self.points
+        return np.vstack([np.asarray(start, dtype=float).reshape(1, 3), self.points])
+
+    def travel_distance(self, start=None):
+        return np.linalg.norm(np.diff(self.path(start), axis=0), axis=1).sum()
+
+    def estimate_travel_time(self, speeds, start=None, settle: float = 0):
+        """
+        全体の移動時間の見積もり．各軸は同時に動くので，1回の移動時間は最も遅い軸で決まる．
+        Args:
+            speeds (list): 軸ごとの(start, final, rate)．HSC103Controller.set_speedで設定した値．
+            start (list(float)): 現在位置．Noneなら最初の点から．
+            settle (float): 1回の移動ごとの待ち時間 [s]．
+
+        Returns:
+            t (float): 移動時間の合計 [s]．
+        """
+        diff = np.abs(np.diff(self.path(start), axis=0))
+        if len(diff) == 0:
+            return 0.0
+        times = np.column_stack([move_time(diff[:, axis], *speeds[axis]) for axis in range(3)])
+        return float(times.max(axis=1).sum() + settle * len(diff))
+
+
+class AdaptiveLinePlan:
+    """
+    start-goal間を粗く測定した後，隣り合うスペクトルの違いが大きい区間に点を足していく．
+    区間の違いは規格化したスペクトルの距離とRayleigh強度の変化の大きい方で評価する．
+    点数がbudgetに達するか，すべての区間の違いがtolerance以下になったら終わる．
+    """
+    def __init__(self, start, goal, coarse: int, budget: int, tolerance: float = 0.05, min_spacing: float = 1):
+        self.start = np.asarray(start, dtype=float)
+        self.goal = np.asarray(goal, dtype=float)
+        self.coarse = max(coarse, 2)
+        self.budget = max(budget, self.coarse)
+        self.tolerance = tolerance
+        self.min_spacing = min_spacing  # これより細かくは分けない [pulse]
+        self.length = np.linalg.norm(self.goal - self.start)
+        self.kind = 'adaptive'
+        self.shape = None
+        self.reset()
+
+    def __len__(self):
+        return self.budget
+
+    def __getitem__(self, index):
+        return self.point(np.linspace(0, 1, self.coarse)[index])
+
+    def reset(self):
+        self.t_measured = []
+        self.spectra = []
+        self.pending = list(np.linspace(0, 1, self.coarse))
+
+    def point(self, t):
+        return self.start + (self.goal - self.start) * t
+
+    def estimate_travel_time(self, speeds, start=None, settle: float = 0):
+        # 追加の点は何往復かに分かれるので，上限の点数を等間隔に並べた場合を目安とする
+        return ScanPlan.line(self.start, self.goal, self.budget).estimate_travel_time(speeds, start, settle)
+
+    def next_point(self):
+        if not self.pending:
+            self.refine()
+        if not self.pending:
+            return None
+        return self.point(self.pending.pop(0))
+
+    def add_result(self, point, spectrum):
+        if self.length == 0:
+            t = 0
+        else:
+            t = float(np.dot(np.asarray(point) - self.start, self.goal - self.start) / self.length ** 2)
+        self.t_measured.append(t)
+        self.spectra.append(np.asarray(spectrum, dtype=float).copy())
+
+    def score(self, spectra):
+        # 隣り合うスペクトルの違い
+        norm = np.linalg.norm(spectra, axis=1, keepdims=True)
+        normalized = spectra / np.where(norm == 0, 1, norm)
+        shape = np.linalg.norm(np.diff(normalized, axis=0), axis=1)
+        intensity = spectra.sum(axis=1)
+        scale = np.abs(intensity).max() or 1
+        return np.maximum(shape, np.abs(np.diff(intensity)) / scale)
+
+    def refine(self):
+        remaining = self.budget - len(self.t_measured)
+        if remaining <= 0 or len(self.t_measured) < 2:
+            return
+        order = np.argsort(self.t_measured)
+        t = np.array(self.t_measured)[order]
+        score = self.score(np.array(self.spectra)[order])
+        gap = np.diff(t) * self.length
+        candidates = np.nonzero((score > self.tolerance) & (gap / 2 >= self.min_spacing))[0]
+        if len(candidates) == 0:
+            return
+        best = candidates[np.argsort(score[candidates])[::-1][:remaining]]
+        t_new = np.sort((t[best] + t[best + 1]) / 2)
+        if abs(self.t_measured[-1] - t_new[-1]) < abs(self.t_measured[-1] - t_new[0]):
+            t_new = t_new[::-1]  # 今いる側から順に測る
+        self.pending = list(t_new)
+
+
+def distance_from(points, point, weights):
+    # 各軸は同時に動くので，重み付きの最大値を距離とする
+    return np.max(np.abs(points - point) * weights, axis=-1)
+
+
+def nearest_neighbour_order(points, start, weights):
+    n = len(points)
+    if n == 0:
+        return np.array([], dtype=int)
+    visited = np.zeros(n, dtype=bool)
+    order = np.empty(n, dtype=int)
+    current = points[0] if start is None else np.asarray(start, dtype=float)
+    for i in range(n):
+        d = distance_from(points, current, weights)
+        d[visited] = np.inf
+        index = int(np.argmin(d))
+        order[i] = index
+        visited[index] = True
+        current = points[index]
+    return order
+
+
+def two_opt_order(points, order, start, weights, max_iteration: int = 100):
+    # 区間を反転して経路が短くなる限り繰り返す．始点は固定，終点は自由
+    path = points[order]
+    if start is not None:
+        path = np.vstack([np.asarray(start, dtype=float).reshape(1, 3), path])
+        order = np.concatenate([[-1], order])
+    n = len(path)
+    for _ in range(max_iteration):
+        improved = False
+        for i in range(1, n - 1):
+            j = np.arange(i + 1, n)
+            before = distance_from(path[i - 1], path[i], weights) + np.append(distance_from(path[j[:-1]], path[j[:-1] + 1], weights), 0)
+            after = distance_from(path[j], path[i - 1], weights) + np.append(distance_from(path[i], path[j[:-1] + 1], weights), 0)
+            gain = before - after
+            best = int(np.argmax(gain))
+            if gain[best] > 1e-9:
+                k = j[best]
+                path[i:k + 1] = path[i:k + 1][::-1]
+                order[i:k + 1] = order[i:k + 1][::-1]
+                improved = True
+        if not improved:
+            break
+    if start is not None:
+        order = order[1:]
+    return order
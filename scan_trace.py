@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+TRACE_EXTENSION = '.trace.json'
+RECENT_POINTS = 10  # 残り時間の見積もりに使う直近の点数
+
+
+class ScanTrace:
+    """
+    スキャンの各段階(移動，静定待ち，露光，読み出し，保存…)にかかった時間を記録する．
+    pathを指定するとChromeのトレース形式(chrome://tracing や Perfetto で開ける)で1件ずつ追記する．
+    段階ごとの合計時間と点ごとの完了時刻はファイルの有無にかかわらず覚えておき，残り時間と内訳の表示に使う．
+    複数のスレッドから呼んでよい．
+    """
+    def __init__(self, path: str = None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.t0 = time.perf_counter()
+        self.t_end = None  # closeした時刻．以降の内訳はここまでの経過時間で割る
+        self.totals = {}  # 段階ごとの合計時間 [s]
+        self.counts = {}
+        self.point_times = []  # 各点が終わった時刻
+        self.f = None
+        if path is not None:
+            self.f = open(path, 'w')
+            self.f.write('[\n')
+
+    def add(self, name: str, t_start: float, t_end: float, point: int = None):
+        """
+        1つの段階を記録する．
+        Args:
+            name (str): 段階の名前．
+            t_start (float): time.perf_counterで測った開始時刻．
+            t_end (float): time.perf_counterで測った終了時刻．
+            point (int): 何点目の段階か．
+        """
+        duration = t_end - t_start
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0) + duration
+            self.counts[name] = self.counts.get(name, 0) + 1
+            if self.f is None:
+                return
+            event = {'name': name, 'ph': 'X', 'ts': round((t_start - self.t0) * 1e6), 'dur': round(duration * 1e6),
+                     'pid': os.getpid(), 'tid': threading.get_ident()}
+            if point is not None:
+                event['args'] = {'point': point}
+            self.f.write(json.dumps(event, separators=(',', ':')) + ',\n')
+
+    @contextmanager
+    def phase(self, name: str, point: int = None):
+        t_start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, t_start, time.perf_counter(), point)
+
+    def track(self, future, name: str, point: int = None):
+        # Futureが終わるまでの時間を記録する．移動命令の送信から返答までなど
+        if not isinstance(future, Future):
+            return future
+        t_start = time.perf_counter()
+        future.add_done_callback(lambda f: self.add(name, t_start, time.perf_counter(), point))
+        return future
+
+    def point_done(self):
+        with self.lock:
+            self.point_times.append(time.perf_counter())
+
+    def eta(self, remaining: int):
+        """
+        直近の点の所要時間から残り時間を見積もる．
+        Args:
+            remaining (int): 残りの点数．
+
+        Returns:
+            eta (float): 残り時間 [s]．まだ1点も終わっていなければNone．
+        """
+        with self.lock:
+            times = [self.t0] + self.point_times[-RECENT_POINTS:]
+        if len(times) < 2:
+            return None
+        return (times[-1] - times[0]) / (len(times) - 1) * remaining
+
+    def format_eta(self, remaining: int):
+        eta = self.eta(remaining)
+        if eta is None:
+            return 'estimating time'
+        minutes, seconds = divmod(int(round(eta)), 60)
+        return f'{minutes}:{seconds:02d} left'
+
+    def summary(self):
+        """
+        段階ごとの合計時間と経過時間に対する割合．保存は別スレッドで移動・露光と重なるので合計は100%を超えうる．
+        Returns:
+            summary (dict): {段階: (合計時間 [s], 割合 [%])}．
+        """
+        elapsed = (self.t_end or time.perf_counter()) - self.t0
+        with self.lock:
+            totals = dict(self.totals)
+        return {name: (total, total / elapsed * 100 if elapsed > 0 else 0) for name, total in totals.items()}
+
+    def format_summary(self):
+        return ' / '.join(f'{name} {percent:.0f}%' for name, (total, percent) in self.summary().items())
+
+    def close(self):
+        if self.t_end is None:
+            self.t_end = time.perf_counter()
+        summary = self.summary()
+        with self.lock:
+            if self.f is None:
+                return
+            # 最後に内訳を1件書いて配列を閉じる
+            event = {'name': 'summary', 'ph': 'i', 's': 'g', 'ts': round((self.t_end - self.t0) * 1e6),
+                     'pid': os.getpid(), 'tid': threading.get_ident(),
+                     'args': {name: {'seconds': round(total, 6), 'percent': round(percent, 2)} for name, (total, percent) in summary.items()}}
+            self.f.write(json.dumps(event, separators=(',', ':')) + '\n]\n')
+            self.f.close()
+            self.f = None
+
+
+def main():
+    trace = ScanTrace('test_trace.json')
+    for i in range(3):
+        with trace.phase('exposure', i + 1):
+            time.sleep(0.01)
+        with trace.phase('readout', i + 1):
+            time.sleep(0.002)
+        trace.point_done()
+        print(trace.format_eta(3 - i - 1))
+    trace.close()
+    print(trace.format_summary())
+    with open('test_trace.json') as f:
+        print(len(json.load(f)), 'events')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import numpy as np
+from spike_removal import fixed_z_batch
+
+CHUNK_SIZE = 256  # 宇宙線除去を一度にかける点数
+
+
+class SpectrumStack:
+    """
+    複数のスペクトルを1つの連続した(点数, 画素数)の配列にまとめて持つ．
+    波長軸は全スペクトルで共有し，名前・位置・時刻は点ごとの配列で持つので，1行ごとのオブジェクトを作らない．
+    dtypeはfloat32にするとメモリが半分になる．処理はdataをその場で書き換える．
+    """
+    __slots__ = ('data', 'wavelength', 'names', 'positions', 'timestamps')
+
+    def __init__(self, data, wavelength=None, names: list = None, positions=None, timestamps=None, dtype=np.float64):
+        self.data = np.asarray(data, dtype=dtype)  # dtypeが同じならコピーしない
+        if self.data.ndim != 2:
+            raise ValueError('data must be a 2D array (spectra, pixels).')
+        num, pixels = self.data.shape
+        self.wavelength = np.arange(pixels, dtype=float) if wavelength is None else np.asarray(wavelength, dtype=float)
+        self.names = [f'{i + 1}of{num}' for i in range(num)] if names is None else list(names)
+        self.positions = np.full((num, 3), np.nan) if positions is None else np.asarray(positions, dtype=float)
+        self.timestamps = np.full(num, np.nan) if timestamps is None else np.asarray(timestamps, dtype=float)
+
+    @classmethod
+    def empty(cls, num: int, pixels: int, wavelength=None, dtype=np.float64):
+        # 読み込む前に配列を確保しておき，1点ずつ埋める
+        return cls(np.zeros((num, pixels), dtype=dtype), wavelength=wavelength, dtype=dtype)
+
+    @classmethod
+    def from_scan(cls, scan, wavelength=None, order=None, dtype=np.float64):
+        """
+        スキャンファイルから作る．並べ替えがなくdtypeも同じならmemmapをそのまま使い，コピーしない．
+        Args:
+            scan (ScanFile): 読み込み用に開いたスキャンファイル．
+            wavelength (np.ndarray): 波長軸．
+            order (np.ndarray): 並べる順番．Noneなら記録順．
+
+        Returns:
+            stack (SpectrumStack): スキャンの全点．
+        """
+        records = scan.records if order is None else scan.records[order]
+        step = scan.settings.get('max_step', len(records))
+        names = [f'{i + 1}of{step}.asc' for i in records['index']]
+        return cls(records['spectrum'], wavelength=wavelength, names=names, positions=records['position'],
+                   timestamps=records['timestamp'], dtype=dtype)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        # スライスなら配列はビューのまま
+        if isinstance(key, (int, np.integer)):
+            key = slice(key, key + 1)
+        names = np.asarray(self.names, dtype=object)[key].tolist()
+        return SpectrumStack(self.data[key], self.wavelength, names, self.positions[key], self.timestamps[key], dtype=self.data.dtype)
+
+    @property
+    def pixels(self):
+        return self.data.shape[1]
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes
+
+    def remove_cosmic_ray(self, times: int = 1, m: int = 3, chunk_size: int = CHUNK_SIZE):
+        """
+        宇宙線を除去してdataを書き換える．一時的に使うメモリはchunk_size点分．
+        Args:
+            times (int): 除去を繰り返す回数．
+            m (int): スパイク周りの補完に用いる片側の幅．
+        """
+        if times <= 0:
+            return
+        if not self.data.flags.writeable:  # 読み込み専用のmemmapはここで初めてコピーする
+            self.data = np.array(self.data)
+        for start in range(0, len(self.data), chunk_size):
+            z = self.data[start:start + chunk_size]
+            for i in range(times):
+                z = fixed_z_batch(z, m)
+            self.data[start:start + chunk_size] = z
@@ -0,0 +1,66 @@
+import numpy as np
+
+
+def modified_z_score(intensity):
+    median_int = np.median(intensity)
+    mad_int = np.median([np.abs(intensity - median_int)])
+    modified_z_scores = 0.6745 * (intensity - median_int) / mad_int
+    return modified_z_scores
+
+
+def fixed_z(y, m):
+    threshold = 7  # 閾値
+    spikes = abs(np.array(modified_z_score(np.diff(y)))) > threshold
+    y_out = y.copy()
+    for i in np.arange(len(spikes)):
+        if spikes[i]:  # If we have a spike in position i
+            w = np.arange(i - m, i + 1 + m)  # スパイク周りの2 m + 1個のデータを取り出す
+            w = w[0 <= w]  # 範囲を超えないようトリミング
+            w = w[w < 1023]
+            w2 = w[spikes[w] == False]  # スパイクでない値を抽出し，
+            if len(w2) > 0:
+                y_out[i] = np.mean(y[w2])  # 平均を計算し補完
+
+    return y_out
+
+
+def fixed_z_batch(y, m):
+    """
+    fixed_zを(N, 画素数)の配列に対してまとめて行う．
+    Args:
+        y (np.ndarray): スペクトルを行に並べた2次元配列．
+        m (int): スパイク周りの補完に用いる片側の幅．
+
+    Returns:
+        y_out (np.ndarray): スパイクを除去した配列．fixed_z(y[i], m)を各行に適用したものと一致する．
+    """
+    threshold = 7  # 閾値
+    y = np.asarray(y)
+    diff = np.diff(y, axis=1)
+    median_int = np.median(diff, axis=1, keepdims=True)
+    mad_int = np.median(np.abs(diff - median_int), axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spikes = np.abs(0.6745 * (diff - median_int) / mad_int) > threshold
+    y_out = y.copy()
+    if not spikes.any():
+        return y_out
+
+    # fixed_zと同じく窓の右端は1023未満に制限する
+    n_spikes = spikes.shape[1]
+    limit = min(1023, n_spikes)
+    total = np.zeros(spikes.shape)
+    count = np.zeros(spikes.shape, dtype=int)
+    for offset in range(-m, m + 1):  # 窓内の位置ごとにまとめて加算
+        lo = max(0, -offset)
+        hi = min(n_spikes, limit - offset)
+        if hi <= lo:
+            continue
+        valid = ~spikes[:, lo + offset:hi + offset]
+        total[:, lo:hi] += np.where(valid, y[:, lo + offset:hi + offset], 0)
+        count[:, lo:hi] += valid
+
+    replace = spikes & (count > 0)
+    rows, cols = np.nonzero(replace)
+    y_out[rows, cols] = total[rows, cols] / count[rows, cols]  # 平均を計算し補完
+
+    return y_out
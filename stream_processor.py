@@ -0,0 +1,107 @@
+import numpy as np
+from scan_file import ScanFile, BackgroundWriter
+from spike_removal import fixed_z_batch
+from calibration_cache import CalibrationCache
+
+PROCESSED_SUFFIX = '_processed'
+
+
+class StreamProcessor:
+    """
+    測定中のスペクトルを1点ずつ受け取り，宇宙線除去をしてメモリ上の配列とファイルに溜めていく．
+    処理はBackgroundWriterのスレッドで順に行うので，submitはすぐに返り測定を止めない．
+    処理や校正で起きた例外はここで受け止めて測定には伝えない．校正に失敗したら校正前の波長軸を使い，
+    処理に失敗した点は数えておいてcloseで知らせる．
+    波長軸は中心波長から求め，キャリブレーション用のスペクトルがあれば最初に校正する．校正した結果はCalibrationCacheに残るので，
+    同じスペクトルで2回目からは多項式を当てはめるだけになる．
+    closeした時点でstackとwavelengthに処理済みのデータが揃っている．
+    """
+    def __init__(self, xpixels: int, capacity: int, center: float = None, calibration_path: str = None,
+                 passes: int = 3, path: str = None, settings: dict = None, cache_path: str = None):
+        self.xpixels = xpixels
+        self.passes = passes  # 宇宙線除去を何回かけるか
+        self.stack = np.zeros((capacity, xpixels))
+        self.positions = np.zeros((capacity, 3))
+        self.num = 0  # 処理済みの点の数
+        if center is None:
+            self.wavelength = np.arange(xpixels, dtype=float)
+        else:
+            self.wavelength = np.linspace(center - 65, center + 65, xpixels)
+        self.path = path
+        self.settings = dict(settings) if settings is not None else {}
+        self.scan_file = None
+        self.cache_path = cache_path  # 校正結果を残すファイル．Noneなら既定の場所
+        self.errors = []  # (何をしていたか, 例外)
+
+        self.worker = BackgroundWriter()
+        if calibration_path is not None and center is not None:
+            self.worker.submit(self.calibrate, center, calibration_path)
+        if path is not None:
+            self.worker.submit(self.run_safely, 'open', self.open_file)
+
+    def run_safely(self, name, func, *args):
+        # workerに例外を残すと次のsubmitで測定側に送出されるので，ここで止める
+        try:
+            func(*args)
+        except Exception as e:
+            self.errors.append((name, e))
+
+    def calibrate(self, center: float, calibration_path: str):
+        # キャリブレーションは使うときだけ読み込む
+        try:
+            from calibration import Calibrator
+            clb = Calibrator()
+            if not clb.set_center(center):
+                print('The nominal wavelength axis is used.')
+                return
+            clb.load_data_from_path(calibration_path)
+            wavelength = CalibrationCache(self.cache_path).calibrate(clb, search_width=4)
+        except Exception as e:
+            print(f'Calibration failed ({e}). The nominal wavelength axis is used.')
+            return
+        if wavelength is False:
+            print('Calibration failed. The nominal wavelength axis is used.')
+            return
+        self.wavelength = np.asarray(wavelength, dtype=float)
+
+    def open_file(self):
+        settings = dict(self.settings, wavelength=self.wavelength.tolist(), spike_removal_passes=self.passes)
+        self.scan_file = ScanFile.create(self.path, self.xpixels, settings=settings)
+
+    def submit(self, index: int, spectrum, position, timestamp: float = None, frames: int = 0):
+        # spectrumはコピーしてから渡す．処理は別スレッドで行う
+        self.worker.submit(self.run_safely, index, self.process, index, spectrum, position, timestamp, frames)
+
+    def process(self, index: int, spectrum, position, timestamp: float = None, frames: int = 0):
+        if index >= len(self.stack):
+            # Adaptiveなどで予定より多くなった場合は倍に広げる
+            size = max(index + 1, 2 * len(self.stack))
+            self.stack = np.resize(self.stack, (size, self.xpixels))
+            self.positions = np.resize(self.positions, (size, 3))
+        y = np.asarray(spectrum, dtype=float)[None, :]
+        for _ in range(self.passes):
+            y = fixed_z_batch(y, 3)
+        self.stack[index] = y[0]
+        self.positions[index] = position
+        self.num = max(self.num, index + 1)
+        if self.scan_file is not None:
+            self.scan_file.append(y[0], position, timestamp=timestamp, index=index, frames=frames)
+            self.scan_file.flush()
+
+    def close(self):
+        """
+        予約済みの処理を終わらせてファイルを閉じる．処理に失敗した点があればここで表示する．
+        Returns:
+            stack (np.ndarray): 処理済みのスペクトル (点数, 画素数)．失敗した点は0のまま．
+        """
+        try:
+            self.worker.close()
+        finally:
+            if self.scan_file is not None:
+                self.scan_file.close()
+        if self.errors:
+            name, e = self.errors[0]
+            print(f'Processing failed {len(self.errors)} times (first at {name}: {e!r}). The raw scan file is not affected.')
+        self.stack = self.stack[:self.num]
+        self.positions = self.positions[:self.num]
+        return self.stack
@@ -0,0 +1,75 @@
+import os
+import numpy as np
+import asc_loader
+from asc_loader import load_asc_folder, CACHE_NAME
+
+PIXELS = 8
+
+
+def write_asc(folder, name, values):
+    path = os.path.join(folder, name)
+    with open(path, 'w') as f:
+        f.write(''.join(f'{v}\n' for v in values))
+    return path
+
+
+def test_cache_reads_only_new_or_changed_files(tmp_path, monkeypatch):
+    folder = str(tmp_path)
+    rng = np.random.default_rng(0)
+    spectra = {f'{i}of3.asc': rng.normal(size=PIXELS).round(6) for i in range(1, 4)}
+    for name in ['1of3.asc', '2of3.asc']:
+        write_asc(folder, name, spectra[name])
+
+    read = []
+    read_files = asc_loader.read_files
+
+    def record(filenames):
+        read.extend(os.path.basename(filename) for filename in filenames)
+        return read_files(filenames)
+    monkeypatch.setattr(asc_loader, 'read_files', record)
+
+    filenames, data = load_asc_folder(folder)
+    assert sorted(read) == ['1of3.asc', '2of3.asc']
+    assert os.path.exists(os.path.join(folder, CACHE_NAME))
+
+    # 変わっていなければ何も読まない
+    read.clear()
+    filenames, data = load_asc_folder(folder)
+    assert read == []
+    np.testing.assert_array_equal(data, [spectra['1of3.asc'], spectra['2of3.asc']])
+
+    # 足したファイルと書き換えたファイルだけを読む
+    read.clear()
+    write_asc(folder, '3of3.asc', spectra['3of3.asc'])
+    spectra['1of3.asc'] = (spectra['1of3.asc'] + 1).round(6)
+    path = write_asc(folder, '1of3.asc', spectra['1of3.asc'])
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))  # 大きさが同じでも更新時刻で気づく
+    filenames, data = load_asc_folder(folder)
+    assert sorted(read) == ['1of3.asc', '3of3.asc']
+    assert [os.path.basename(filename) for filename in filenames] == ['1of3.asc', '2of3.asc', '3of3.asc']
+    np.testing.assert_array_equal(data, [spectra[name] for name in ['1of3.asc', '2of3.asc', '3of3.asc']])
+
+
+def test_incomplete_file_is_read_again(tmp_path, monkeypatch):
+    folder = str(tmp_path)
+    values = np.arange(PIXELS, dtype=float)
+    for i in range(1, 3):
+        write_asc(folder, f'{i}of3.asc', values * i)
+    write_asc(folder, '3of3.asc', values[:3])  # 書きかけ
+
+    filenames, data = load_asc_folder(folder)
+    assert [os.path.basename(filename) for filename in filenames] == ['1of3.asc', '2of3.asc']
+
+    read = []
+    read_files = asc_loader.read_files
+
+    def record(filenames):
+        read.extend(os.path.basename(filename) for filename in filenames)
+        return read_files(filenames)
+    monkeypatch.setattr(asc_loader, 'read_files', record)
+
+    write_asc(folder, '3of3.asc', values * 3)
+    filenames, data = load_asc_folder(folder)
+    assert read == ['3of3.asc']
+    np.testing.assert_array_equal(data, [values, values * 2, values * 3])
@@ -0,0 +1,48 @@
+import contextlib
+import io
+import numpy as np
+import pytest
+from calibration import Calibrator, PEAKS, match_lines
+
+
+def lamp_spectrum(center: float, offset: float, seed: int = 0):
+    # 校正前の波長軸が実際よりoffset [nm]ずれたHg-Arランプのスペクトル
+    rng = np.random.default_rng(seed)
+    x = np.linspace(center - 65, center + 65, 1024)
+    y = 100 + rng.normal(0, 3, x.size)
+    for line in PEAKS:
+        y += 4000 * np.exp(-(x + offset - line) ** 2 / (2 * 0.15 ** 2))
+    return y
+
+
+def test_match_lines_keeps_doublet_order():
+    # 2つのピークがどちらも2本の線より短波長側にある．距離の和では入れ替えても同じになる配置
+    lines = [750.3869, 751.4652]
+    for x_found in ([747.89, 748.97], [753.4, 754.5]):
+        peak_indices, line_indices = match_lines(x_found, [1000, 1000], lines)
+        assert peak_indices.tolist() == [0, 1]
+        assert line_indices.tolist() == [0, 1]
+
+
+@pytest.mark.parametrize('center, offset', [(760, 2.5), (760, -3.0), (630, 1.5), (500, -2.0)])
+def test_calibrate_shifted_doublets(center, offset):
+    clb = Calibrator()
+    clb.set_center(center)
+    clb.load_data_from_array(lamp_spectrum(center, offset))
+    with contextlib.redirect_stdout(io.StringIO()):
+        x_calibrated = clb.calibrate()
+    assert x_calibrated is not False
+
+    # 対応づけた線は波長の順で，各ピークはずらした分だけ離れた線に対応する
+    x_detected = clb.x[clb.indices_detected]
+    assert np.all(np.diff(x_detected) > 0)
+    np.testing.assert_allclose(x_detected + offset, clb.peaks_matched, atol=0.2)
+
+
+def test_center_without_lines_is_not_calibrated():
+    clb = Calibrator()
+    with contextlib.redirect_stdout(io.StringIO()):
+        assert clb.set_center(300) is False
+        clb.load_data_from_array(lamp_spectrum(300, 0))
+        assert clb.calibrate() is False
+    assert clb.set_center(760) is True
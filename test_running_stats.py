@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from data_processor import RunningStats
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 100, 1000])
+def test_update_matches_numpy(chunk_size):
+    # 平均が大きくばらつきが小さい，桁落ちしやすいデータ
+    rng = np.random.default_rng(0)
+    data = 1e6 + rng.normal(0, 1, (300, 3))
+    stats = RunningStats()
+    for start in range(0, len(data), chunk_size):
+        stats.update(data[start:start + chunk_size])
+    assert stats.n == data.size
+    np.testing.assert_allclose(stats.mean, np.mean(data), rtol=1e-12)
+    np.testing.assert_allclose(stats.std, np.std(data), rtol=1e-9)
+
+
+def test_merge_matches_numpy():
+    # 窓ごとに別に集計した(点数, 平均, 偏差平方和)を合わせても全体と同じになる
+    rng = np.random.default_rng(1)
+    windows = [rng.normal(loc, scale, size) for loc, scale, size in [(0, 1, 50), (10, 3, 7), (-5, 0.5, 200), (3, 2, 0)]]
+    stats = RunningStats()
+    for window in windows:
+        part = RunningStats()
+        part.update(window)
+        stats.merge(part.n, part.mean, part.m2)
+    data = np.concatenate(windows)
+    assert stats.n == data.size
+    np.testing.assert_allclose(stats.mean, np.mean(data), rtol=1e-12)
+    np.testing.assert_allclose(stats.std, np.std(data), rtol=1e-12)
+
+
+def test_empty():
+    stats = RunningStats()
+    stats.update([])
+    assert stats.n == 0
+    assert stats.std == 0.0
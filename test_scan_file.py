@@ -0,0 +1,66 @@
+import numpy as np
+from scan_file import ScanFile
+from scan_journal import ScanJournal
+
+PIXELS = 16
+
+
+def write_points(scan, journal, spectra, start=0):
+    for i, spectrum in enumerate(spectra, start):
+        offset = scan.append(spectrum, [i, 0, 0], timestamp=float(i), index=i)
+        journal.add_point(i, [i, 0, 0], None, offset, timestamp=float(i))
+
+
+def test_torn_last_line_is_dropped(tmp_path):
+    path = str(tmp_path / 'scan.journal')
+    journal = ScanJournal.create(path, {'job': {}})
+    journal.add_point(0, [0, 0, 0], None, 64)
+    journal.close()
+
+    # 書きかけの行は，JSONとして読めても改行がなければ捨てる
+    for torn in ('{"type":"point","ind', '{"type":"end"}'):
+        with open(path, 'rb+') as f:
+            data = f.read()
+            f.seek(0)
+            f.truncate()
+            f.write(data[:data.rfind(b'\n') + 1] + torn.encode())
+        header, points, finished = ScanJournal.read(path)
+        assert [point['index'] for point in points] == [0]
+        assert not finished
+
+
+def test_resume_interrupted_scan(tmp_path):
+    rng = np.random.default_rng(0)
+    spectra = rng.normal(size=(5, PIXELS))
+    scan_path = str(tmp_path / 'scan.rscan')
+    journal_path = str(tmp_path / 'scan.journal')
+
+    # 3点目まで記録したところで，スキャンファイルと記録の両方に書きかけを残して止まった状況
+    scan = ScanFile.create(scan_path, PIXELS)
+    journal = ScanJournal.create(journal_path, {'job': {}}, dependents=[scan.f])
+    write_points(scan, journal, spectra[:3])
+    journal.close()
+    scan.append(np.zeros(PIXELS), [9, 9, 9])  # 記録に載る前のレコード
+    scan.f.write(b'\0' * 10)  # 書きかけのレコード
+    scan.close()
+    with open(journal_path, 'a') as f:
+        f.write('{"type":"point","index":3,')
+
+    # 記録にある点だけ残して続きを追記する
+    header, points, finished = ScanJournal.read(journal_path)
+    assert len(points) == 3
+    scan = ScanFile.open_append(scan_path, len(points))
+    journal = ScanJournal.open_append(journal_path, dependents=[scan.f])
+    write_points(scan, journal, spectra[3:], start=3)
+    journal.finish()
+    scan.close()
+
+    header, points, finished = ScanJournal.read(journal_path)
+    assert finished
+    assert [point['index'] for point in points] == list(range(5))
+    scan = ScanFile.open(scan_path)
+    assert len(scan) == 5
+    np.testing.assert_array_equal(scan.spectra, spectra)
+    np.testing.assert_array_equal(scan.records['index'], np.arange(5))
+    for i, point in enumerate(points):
+        assert point['offset'] == scan.header_len + i * scan.dtype.itemsize
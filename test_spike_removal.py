@@ -0,0 +1,25 @@
+import numpy as np
+from spike_removal import fixed_z, fixed_z_batch
+
+
+def test_fixed_z_batch_matches_fixed_z():
+    rng = np.random.default_rng(0)
+    y = rng.normal(100, 5, (20, 1024))
+    rows = rng.integers(0, 20, 60)
+    cols = rng.integers(0, 1024, 60)
+    y[rows, cols] += rng.uniform(500, 5000, 60)  # 宇宙線
+    y[3, :4] += 3000  # 端のスパイク
+    y[4, -4:] += 3000
+
+    expected = np.array([fixed_z(row, 3) for row in y])
+    np.testing.assert_allclose(fixed_z_batch(y, 3), expected)
+
+
+def test_fixed_z_batch_keeps_input():
+    rng = np.random.default_rng(1)
+    y = rng.normal(100, 5, (4, 1024))
+    y[1, 500] += 4000
+    original = y.copy()
+    out = fixed_z_batch(y, 3)
+    np.testing.assert_array_equal(y, original)
+    assert out[1, 500] < 200